@@ -0,0 +1,161 @@
+"""Speed and memory benchmarks of the classifiers on random batches.
+
+    python benchmark.py amp --data cmnist celebA --batch_size 64
+
+    python benchmark.py compile --data cmnist --batch_size 16 64
+
+amp: fp32 against bf16 autocast (--amp) for a training step of a phase and for
+evaluation forwards. Reports images per second, the memory autograd keeps for backward
+and, on CUDA, the peak allocated memory.
+compile: eager against per-phase compiled forwards (--compile). Reports the training step
+time of each phase and the time of its first, compiling step.
+"""
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from main import get_parser
+from model.build_models import build_model
+from data.transforms import num_classes
+from prune.Compile import compile_phases
+
+image_size = {'cmnist': 28, 'cifar10c': 32, 'bffhq': 128, 'celebA': 224}
+
+
+def build_classifier(data, device):
+    args = get_parser().parse_args(['--mode', 'prune', '--data', data])
+    args.imagenet = False # No download, the weights do not matter here
+    torch.manual_seed(0)
+    return build_model(args).classifier.to(device)
+
+
+def set_phase(net, phase):
+    net.pruning_switch(phase == 'prune')
+    net.freeze_switch(phase == 'retrain')
+
+
+def random_batch(data, batch_size, device):
+    x = torch.randn(batch_size, 3, image_size[data], image_size[data], device=device)
+    y = torch.randint(num_classes[data], (batch_size,), device=device)
+    return x, y
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def seconds_per_call(fn, device, iters, warmup):
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start) / iters
+
+
+def saved_bytes(fn):
+    """Bytes of the tensors autograd saves for backward while running fn()"""
+    saved = {}
+
+    def pack(t):
+        saved[(t.data_ptr(), t.dtype)] = t.numel() * t.element_size()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        fn()
+    return sum(saved.values())
+
+
+def training_step(net, optimizer, x, y, autocast):
+    def step():
+        with autocast():
+            loss = F.cross_entropy(net(x), y)
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        optimizer.step()
+    return step
+
+
+def benchmark_amp(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print(f'{args.phase} step, batch size {args.batch_size}, {device}')
+    print('%-9s %-5s %12s %12s %10s %10s %8s' % ('data', 'prec', 'train img/s', 'eval img/s',
+                                                 'saved MB', 'peak MB', 'speedup'))
+    for data in args.data:
+        x, y = random_batch(data, args.batch_size, device)
+        base = None
+        for dtype in [None, torch.bfloat16]:
+            net = build_classifier(data, device)
+            set_phase(net, args.phase)
+            optimizer = torch.optim.SGD(net.parameters(), lr=1e-3)
+            autocast = lambda: torch.autocast(device.type, dtype=torch.bfloat16, enabled=dtype is not None)
+            step = training_step(net, optimizer, x, y, autocast)
+
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats()
+            train_time = seconds_per_call(step, device, args.iters, args.warmup)
+            peak = torch.cuda.max_memory_allocated() / 2**20 if device.type == 'cuda' else float('nan')
+            with autocast():
+                saved = saved_bytes(lambda: net(x)) / 2**20
+
+            net.eval()
+            with torch.no_grad(), autocast():
+                eval_time = seconds_per_call(lambda: net(x), device, args.iters, args.warmup)
+
+            base = base or train_time
+            print('%-9s %-5s %12.1f %12.1f %10.1f %10.1f %7.2fx' % (
+                data, 'bf16' if dtype else 'fp32', args.batch_size / train_time,
+                args.batch_size / eval_time, saved, peak, base / train_time))
+
+
+def benchmark_compile(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print(f'Training step time, {device}')
+    print('%-9s %6s %-9s %10s %10s %10s %8s' % ('data', 'batch', 'phase', 'eager ms', 'compiled ms',
+                                                'first ms', 'speedup'))
+    autocast = lambda: torch.autocast(device.type, enabled=False)
+    for data in args.data:
+        for batch_size in args.batch_size:
+            x, y = random_batch(data, batch_size, device)
+            eager, compiled = build_classifier(data, device), compile_phases(build_classifier(data, device))
+            for phase in ['pretrain', 'prune', 'retrain']:
+                times = []
+                for net in [eager, compiled]:
+                    set_phase(net, phase)
+                    step = training_step(net, torch.optim.SGD(net.parameters(), lr=1e-3), x, y, autocast)
+                    start = time.perf_counter()
+                    step()
+                    synchronize(device)
+                    first = time.perf_counter() - start
+                    times.append(seconds_per_call(step, device, args.iters, args.warmup))
+                print('%-9s %6d %-9s %10.2f %11.2f %10.1f %7.2fx' % (
+                    data, batch_size, phase, times[0] * 1e3, times[1] * 1e3, first * 1e3, times[0] / times[1]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    amp = subparsers.add_parser('amp', help='fp32 against bf16 autocast')
+    amp.add_argument('--data', type=str, nargs='+', default=['cmnist', 'cifar10c', 'bffhq', 'celebA'],
+                     choices=list(image_size))
+    amp.add_argument('--phase', type=str, default='prune', choices=['pretrain', 'prune', 'retrain'])
+    amp.add_argument('--batch_size', type=int, default=64)
+    amp.add_argument('--iters', type=int, default=10)
+    amp.add_argument('--warmup', type=int, default=3)
+    amp.set_defaults(run=benchmark_amp)
+
+    compile = subparsers.add_parser('compile', help='Eager against per-phase compiled forwards')
+    compile.add_argument('--data', type=str, nargs='+', default=['cmnist'], choices=list(image_size))
+    compile.add_argument('--batch_size', type=int, nargs='+', default=[16, 64, 256])
+    compile.add_argument('--iters', type=int, default=50)
+    compile.add_argument('--warmup', type=int, default=5)
+    compile.set_defaults(run=benchmark_compile)
+
+    args = parser.parse_args()
+    args.run(args)
@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import torch
+from torch.utils import data
+from torch.utils.data.dataset import Dataset
+
+from data.data_loader import get_transform, dataset_name_dict
+from data.dataset import IdxDataset
+from util import distributed
+from util.storage import atomic_save, LazyMemmap
+
+
+class ActivationCache(LazyMemmap, Dataset):
+    """Prefix activations [N, C, H, W] of the train split, indexed like IdxDataset.
+
+    Items are (idx, activation, attr, '') so that the fetchers and samplers work unchanged.
+    `activations` is a float16 array in RAM, or the path of a .npy mapped in every
+    DataLoader worker.
+    """
+    def __init__(self, activations, attr_array):
+        self.path = activations if isinstance(activations, str) else None
+        self._activations = None if self.path else activations
+        self.attr_array = attr_array
+
+    @property
+    def activations(self):
+        return self.mapped(self.path) if self.path else self._activations
+
+    def __len__(self):
+        return len(self.attr_array)
+
+    def __getitem__(self, index):
+        activation = torch.from_numpy(np.array(self.activations[index], dtype=np.float32))
+        return index, activation, self.attr_array[index], ''
+
+
+def build_activation_cache(args, model, device, fname=None):
+    """Run model.prefix once over the train split, without augmentation and in eval mode
+    (BatchNorm uses its running statistics). With `fname`, the activations are written to
+    a .npy file, which is reused if it already exists; otherwise they are kept in RAM."""
+    transform, collate_fn = get_transform(args, 'test')
+    dataset = dataset_name_dict[args.data](root=args.train_root_dir, name=args.data, split='train',
+                                           transform=transform, conflict_pct=args.conflict_pct,
+                                           use_memmap=args.use_memmap)
+    if fname is not None:
+        distributed.barrier() # Every rank checks before rank 0 may create it
+    if fname is not None and os.path.exists(fname):
+        print(f'Load prefix activations from {fname}')
+        return ActivationCache(fname, dataset.attr_array)
+
+    if fname is not None and not distributed.is_main_process():
+        distributed.barrier() # Rank 0 writes the file
+        return ActivationCache(fname, dataset.attr_array)
+
+    loader = data.DataLoader(IdxDataset(dataset), batch_size=args.batch_size, shuffle=False,
+                             num_workers=args.num_workers, collate_fn=collate_fn, pin_memory=True)
+
+    def fill(allocate):
+        # Activations [N, ...] in the array returned by allocate(shape)
+        was_training = model.training
+        model.eval()
+        activations = None
+        with torch.no_grad():
+            for idx, x, _, _ in loader:
+                out = model.prefix(x.to(device)).half().cpu().numpy()
+                if activations is None:
+                    activations = allocate((len(dataset), *out.shape[1:]))
+                activations[idx.numpy()] = out
+        model.train(was_training)
+        return activations
+
+    if fname is None:
+        return ActivationCache(fill(lambda shape: np.empty(shape, dtype=np.float16)), dataset.attr_array)
+
+    def write(tmp):
+        fill(lambda shape: np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float16, shape=shape)).flush()
+    atomic_save(fname, write)
+    print(f'Saved prefix activations in {fname}')
+    distributed.barrier()
+    return ActivationCache(fname, dataset.attr_array)
@@ -0,0 +1,215 @@
+"""Batched counterparts of the torchvision pipelines in data/transforms.py.
+
+Workers only convert images to uint8 tensors; crop, flip and normalization run once per
+collated batch [B, C, H, W] with per-sample random parameters. Used with `--batch_transform`.
+Ops after BatchToFloat work in place on the float batch it allocates.
+"""
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+from torchvision import transforms as T
+
+
+class BatchCompose(object):
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, x):
+        for t in self.transforms:
+            x = t(x)
+        return x
+
+
+class BatchToFloat(object):
+    """uint8 [0, 255] -> float [0, 1], as T.ToTensor"""
+    def __call__(self, x):
+        return x.float().div_(255)
+
+
+class BatchNormalize(object):
+    def __init__(self, mean, std):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, x):
+        return x.sub_(self.mean.to(x.device)).div_(self.std.to(x.device))
+
+
+class BatchResize(object):
+    """Match the smaller edge to `size`, as T.Resize(int)"""
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, x):
+        h, w = x.shape[-2:]
+        if min(h, w) == self.size:
+            return x
+        if h <= w:
+            out_size = (self.size, int(self.size * w / h))
+        else:
+            out_size = (int(self.size * h / w), self.size)
+        return F.interpolate(x, size=out_size, mode='bilinear', align_corners=False, antialias=True)
+
+
+class BatchCenterCrop(object):
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, x):
+        h, w = x.shape[-2:]
+        top = int(round((h - self.size) / 2.))
+        left = int(round((w - self.size) / 2.))
+        return x[..., top:top + self.size, left:left + self.size]
+
+
+class BatchRandomHorizontalFlip(object):
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, x):
+        flip = (torch.rand(x.size(0), device=x.device) < self.p).nonzero().squeeze(1)
+        x[flip] = x[flip].flip(-1)
+        return x
+
+
+class BatchRandomCrop(object):
+    """T.RandomCrop(size, padding) with zero padding and an independent offset per sample"""
+    def __init__(self, size, padding=0):
+        self.size = size
+        self.padding = padding
+
+    def __call__(self, x):
+        x = F.pad(x, [self.padding] * 4)
+        b, c, h, w = x.shape
+        top = torch.randint(0, h - self.size + 1, (b, 1), device=x.device)
+        left = torch.randint(0, w - self.size + 1, (b, 1), device=x.device)
+        arange = torch.arange(self.size, device=x.device)
+        rows = (top + arange).view(b, 1, self.size, 1)
+        cols = (left + arange).view(b, 1, 1, self.size)
+        return x[torch.arange(b, device=x.device).view(b, 1, 1, 1),
+                 torch.arange(c, device=x.device).view(1, c, 1, 1),
+                 rows, cols]
+
+
+class BatchRandomResizedCrop(object):
+    """T.RandomResizedCrop with per-sample boxes, resampled by a single grid_sample call.
+    Box sampling follows T.RandomResizedCrop.get_params: 10 attempts, then a center crop."""
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), attempts=10):
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+        self.attempts = attempts
+
+    def get_params(self, b, height, width, device):
+        area = height * width
+        log_ratio = torch.log(torch.tensor(self.ratio, device=device))
+        target_area = area * torch.empty(b, self.attempts, device=device).uniform_(*self.scale)
+        aspect_ratio = torch.exp(torch.empty(b, self.attempts, device=device).uniform_(*log_ratio.tolist()))
+        w = torch.round(torch.sqrt(target_area * aspect_ratio))
+        h = torch.round(torch.sqrt(target_area / aspect_ratio))
+        valid = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+
+        # Fallback to whole image (center crop if the aspect ratio is out of range)
+        in_ratio = width / height
+        if in_ratio < min(self.ratio):
+            fw, fh = width, int(round(width / min(self.ratio)))
+        elif in_ratio > max(self.ratio):
+            fw, fh = int(round(height * max(self.ratio))), height
+        else:
+            fw, fh = width, height
+
+        found = valid.any(1)
+        first = valid.float().argmax(1, keepdim=True)
+        w = torch.where(found, w.gather(1, first).squeeze(1), torch.full_like(found, fw, dtype=w.dtype))
+        h = torch.where(found, h.gather(1, first).squeeze(1), torch.full_like(found, fh, dtype=h.dtype))
+        top = torch.where(found, torch.floor(torch.rand(b, device=device) * (height - h + 1)),
+                          torch.div(height - h, 2, rounding_mode='floor'))
+        left = torch.where(found, torch.floor(torch.rand(b, device=device) * (width - w + 1)),
+                           torch.div(width - w, 2, rounding_mode='floor'))
+        return top, left, h, w
+
+    def __call__(self, x):
+        b, _, height, width = x.shape
+        top, left, h, w = self.get_params(b, height, width, x.device)
+
+        # Affine map from output to input in normalized coordinates (align_corners=False)
+        theta = torch.zeros(b, 2, 3, device=x.device, dtype=x.dtype)
+        theta[:, 0, 0] = w / width
+        theta[:, 0, 2] = (2 * left + w) / width - 1
+        theta[:, 1, 1] = h / height
+        theta[:, 1, 2] = (2 * top + h) / height - 1
+        grid = F.affine_grid(theta, [b, x.size(1), self.size, self.size], align_corners=False)
+        return F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+
+class BatchCollate(object):
+    """default_collate, then apply `transform` to the image batch of (idx, image, attr, fname)"""
+    def __init__(self, transform, image_pos=1):
+        self.transform = transform
+        self.image_pos = image_pos
+
+    def __call__(self, batch):
+        batch = default_collate(batch)
+        batch[self.image_pos] = self.transform(batch[self.image_pos])
+        return batch
+
+
+imagenet_mean_std = ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+cifar_mean_std = ((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010))
+
+# 'sample' runs in the workers, 'batch' on the collated batch
+batch_transforms = {
+    "cmnist": {
+        "train": {"sample": T.PILToTensor(),
+                  "batch": BatchCompose([BatchToFloat(), BatchResize(28)])},
+        "valid": {"sample": T.PILToTensor(),
+                  "batch": BatchCompose([BatchToFloat(), BatchResize(28)])},
+        "test": {"sample": T.PILToTensor(),
+                 "batch": BatchCompose([BatchToFloat(), BatchResize(28)])},
+    },
+    "celebA": {
+        "train": {"sample": T.PILToTensor(),
+                  "batch": BatchCompose([
+                      BatchToFloat(),
+                      BatchRandomResizedCrop(224, scale=(0.7, 1.0), ratio=(0.75, 1.3333333333333333)),
+                      BatchRandomHorizontalFlip(),
+                      BatchNormalize(*imagenet_mean_std),
+                  ])},
+        "valid": {"sample": T.PILToTensor(),
+                  "batch": BatchCompose([
+                      BatchToFloat(), BatchResize(256), BatchCenterCrop(224),
+                      BatchNormalize(*imagenet_mean_std),
+                  ])},
+        "test": {"sample": T.PILToTensor(),
+                 "batch": BatchCompose([
+                     BatchToFloat(), BatchResize(256), BatchCenterCrop(224),
+                     BatchNormalize(*imagenet_mean_std),
+                 ])},
+    },
+    "bffhq": {
+        "train": {"sample": T.PILToTensor(),
+                  "batch": BatchCompose([
+                      BatchToFloat(), BatchResize(128), BatchRandomHorizontalFlip(),
+                      BatchNormalize(*cifar_mean_std),
+                  ])},
+        "valid": {"sample": T.PILToTensor(),
+                  "batch": BatchCompose([
+                      BatchToFloat(), BatchResize(128), BatchNormalize(*cifar_mean_std),
+                  ])},
+        "test": {"sample": T.PILToTensor(),
+                 "batch": BatchCompose([
+                     BatchToFloat(), BatchResize(128), BatchNormalize(*cifar_mean_std),
+                 ])},
+    },
+    "cifar10c": {
+        "train": {"sample": T.PILToTensor(),
+                  "batch": BatchCompose([
+                      BatchToFloat(), BatchRandomCrop(32, padding=4), BatchRandomHorizontalFlip(),
+                      BatchNormalize(*cifar_mean_std),
+                  ])},
+        "valid": {"sample": T.PILToTensor(),
+                  "batch": BatchCompose([BatchToFloat(), BatchNormalize(*cifar_mean_std)])},
+        "test": {"sample": T.PILToTensor(),
+                 "batch": BatchCompose([BatchToFloat(), BatchNormalize(*cifar_mean_std)])},
+    },
+}
@@ -0,0 +1,37 @@
+"""Decode a dataset once into memory-mapped arrays, used with `main.py --use_memmap`.
+
+    python -m data.build_memmap --data bffhq --conflict_pct 0.5
+"""
+import os
+import argparse
+
+from data.data_loader import dataset_name_dict
+from data.memmap import pack_dataset, memmap_dir
+
+
+def main(args):
+    dataset_class = dataset_name_dict[args.data]
+    packed = set()
+    for split in args.splits:
+        dataset = dataset_class(root=args.root, split=split, transform=None,
+                                conflict_pct=args.conflict_pct)
+        if len(dataset) == 0:
+            print(f'No images found for split {split}, skipped.')
+            continue
+        prefix = os.path.join(memmap_dir(args.root, dataset.name), dataset.split_key(split))
+        if prefix in packed:
+            # e.g. the 'valid' split of celebA is its 'test' split
+            print(f'Split {split} shares {prefix}, skipped.')
+            continue
+        pack_dataset(dataset, prefix)
+        packed.add(prefix)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default='cmnist',
+                        choices=['cmnist', 'cifar10c', 'bffhq', 'celebA'])
+    parser.add_argument('--conflict_pct', type=float, default=5., choices=[0.5, 1., 2., 5.])
+    parser.add_argument('--root', type=str, default='dataset')
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'valid', 'test'])
+    main(parser.parse_args())
@@ -1,11 +1,17 @@
 import os
+import queue
+import threading
+
 import torch
-from torch.utils.data import WeightedRandomSampler
 from torch.utils import data
 from munch import Munch
 from data.transforms import transforms, use_preprocess
+from data.batch_transforms import batch_transforms, BatchCollate
 from data.dataset import CMNISTDataset, CIFAR10Dataset, bFFHQDataset, \
     CelebADataset, IdxDataset
+from data.sampler import InfiniteWeightedSampler, DistributedWeightedSampler, EpochDistributedSampler, \
+    EpochRandomSampler, seeded_generator
+from util import distributed
 
 
 dataset_name_dict = {'cifar10c': CIFAR10Dataset,
@@ -13,50 +19,126 @@ dataset_name_dict = {'cifar10c': CIFAR10Dataset,
                      'bffhq': bFFHQDataset,
                      'celebA': CelebADataset}
 
-def get_original_loader(args, return_dataset=False, sampling_weight=None):
+def get_transform(args, split):
+    # Returns (per-sample transform, collate_fn)
     dataset_name = args.data
-    transform = transforms['preprocess' if use_preprocess[dataset_name] else 'original'][dataset_name]['train']
-    dataset_class = dataset_name_dict[dataset_name]
+    if args.batch_transform:
+        transform = batch_transforms[dataset_name][split]
+        return transform['sample'], BatchCollate(transform['batch'])
+    transform = transforms['preprocess' if use_preprocess[dataset_name] else 'original'][dataset_name][split]
+    return transform, None
 
-    dataset = dataset_class(root=args.train_root_dir, name=dataset_name, split='train',
-                            transform=transform, conflict_pct=args.conflict_pct)
-    if return_dataset:
-        return dataset
+def get_original_loader(args, return_dataset=False, sampling_weight=None, shard=True, dataset=None,
+                        salt='train'):
+    """With torch.distributed (and `shard`), every process loads its shard of each batch.
+    `dataset` replaces the train split by an already indexed dataset (e.g. ActivationCache).
+    The order of the batches only depends on args.seed and `salt`, a name distinguishing
+    the loaders of a run (see InputFetcher(start=...))."""
+    dataset_name = args.data
+    if dataset is not None:
+        collate_fn = None
     else:
+        transform, collate_fn = get_transform(args, 'train')
+        dataset_class = dataset_name_dict[dataset_name]
+
+        dataset = dataset_class(root=args.train_root_dir, name=dataset_name, split='train',
+                                transform=transform, conflict_pct=args.conflict_pct,
+                                use_memmap=args.use_memmap)
+        if return_dataset:
+            return dataset
         dataset = IdxDataset(dataset)
-        if sampling_weight is not None:
-            #TODO: replace?
-            sampler = WeightedRandomSampler(sampling_weight, args.batch_size, replacement=True)
-            return data.DataLoader(dataset=dataset,
-                                   batch_size=args.batch_size,
-                                   shuffle=False,
-                                   num_workers=args.num_workers,
-                                   sampler=sampler,
-                                   pin_memory=True)
-        else:
-            return data.DataLoader(dataset=dataset,
-                                batch_size=args.batch_size,
-                                shuffle=True,
-                                num_workers=args.num_workers,
-                                pin_memory=True)
+    num_shards = distributed.get_world_size() if shard and distributed.is_distributed() else 1
+    if args.batch_size % num_shards != 0:
+        raise ValueError(f'--batch_size must be a multiple of the number of processes ({num_shards})')
+    rank, batch_size = distributed.get_rank(), args.batch_size // num_shards
+    # Worker seeds are drawn from this generator instead of the global RNG
+    generator = seeded_generator(args.seed, f'{salt}_workers')
+
+    per_replica = sampling_weight is not None and sampling_weight.dim() == 2
+    if sampling_weight is not None and (args.stream_sampling or per_replica):
+        # Never-ending sampler: workers stay alive and keep prefetching across steps.
+        # 2-D weights [K, N] give K concatenated batches, one per replica
+        sampler = InfiniteWeightedSampler(sampling_weight, args.batch_size, seed=args.seed,
+                                          rank=rank, num_shards=num_shards, salt=salt)
+        num_batches = sampling_weight.shape[0] if per_replica else 1
+        return data.DataLoader(dataset=dataset,
+                               batch_size=batch_size * num_batches,
+                               shuffle=False,
+                               num_workers=args.num_workers,
+                               sampler=sampler,
+                               collate_fn=collate_fn,
+                               pin_memory=True,
+                               generator=generator,
+                               persistent_workers=args.num_workers > 0)
+    elif sampling_weight is not None:
+        # One batch per epoch: the fetcher re-creates the iterator (and workers) every step
+        sampler = DistributedWeightedSampler(sampling_weight, args.batch_size, rank, num_shards,
+                                             seed=args.seed, salt=salt)
+        return data.DataLoader(dataset=dataset,
+                               batch_size=batch_size,
+                               shuffle=False,
+                               num_workers=args.num_workers,
+                               sampler=sampler,
+                               collate_fn=collate_fn,
+                               pin_memory=True,
+                               generator=generator)
+    elif num_shards > 1:
+        sampler = EpochDistributedSampler(dataset, num_replicas=num_shards, rank=rank, seed=args.seed,
+                                          salt=salt)
+        return data.DataLoader(dataset=dataset,
+                               batch_size=batch_size,
+                               shuffle=False,
+                               num_workers=args.num_workers,
+                               sampler=sampler,
+                               collate_fn=collate_fn,
+                               pin_memory=True,
+                               generator=generator)
+    else:
+        return data.DataLoader(dataset=dataset,
+                            batch_size=args.batch_size,
+                            shuffle=False,
+                            num_workers=args.num_workers,
+                            sampler=EpochRandomSampler(len(dataset), seed=args.seed, salt=salt),
+                            collate_fn=collate_fn,
+                            pin_memory=True,
+                            generator=generator)
+
+def get_sequential_loader(args, loader):
+    # The whole (unsharded) dataset of `loader` in dataset order, without building it again
+    return data.DataLoader(dataset=loader.dataset,
+                           batch_size=args.batch_size,
+                           shuffle=False,
+                           num_workers=args.num_workers,
+                           collate_fn=loader.collate_fn,
+                           pin_memory=True,
+                           generator=seeded_generator(args.seed, 'train_all_workers'))
 
 def get_val_loader(args, split='test'):
     dataset_name = args.data
-    transform = transforms['preprocess' if use_preprocess[dataset_name] else 'original'][dataset_name]['test']
+    transform, collate_fn = get_transform(args, 'test')
     dataset_class = dataset_name_dict[dataset_name]
 
-    dataset = dataset_class(root=args.val_root_dir, split=split, transform=transform)
+    dataset = dataset_class(root=args.val_root_dir, split=split, transform=transform,
+                            use_memmap=args.use_memmap)
     dataset = IdxDataset(dataset)
     return data.DataLoader(dataset=dataset,
                            batch_size=args.batch_size,
                            shuffle=True,
                            num_workers=args.num_workers,
+                           collate_fn=collate_fn,
                            pin_memory=True)
 
 class InputFetcher:
-    def __init__(self, loader):
+    """`consumed` counts the batches handed out. With `start`, the sampler of `loader`
+    (see data/sampler.py) skips the first `start` batches of its stream."""
+    def __init__(self, loader, start=0):
         self.loader = loader
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # The current device of the caller, i.e. cuda:<local rank> under DDP
+        self.device = torch.device('cuda', torch.cuda.current_device()) if torch.cuda.is_available() \
+            else torch.device('cpu')
+        self.consumed = start
+        if start > 0:
+            self.loader.sampler.resume(start, self.loader.batch_size)
 
     def _fetch(self):
         try:
@@ -68,6 +150,7 @@ class InputFetcher:
 
     def __next__(self):
         idx, x, attr, fname = self._fetch()
+        self.consumed += 1
         y = attr[:, 0]
         bias_label = attr[:, 1]
 
@@ -76,3 +159,74 @@ class InputFetcher:
         return Munch({k: v if 'fname' in k else v.to(self.device)
                       for k, v in inputs.items()})
 
+    def close(self):
+        pass
+
+
+class PrefetchInputFetcher(InputFetcher):
+    """InputFetcher whose batches are loaded and copied to the device by a background
+    thread, `num_prefetch` batches ahead. Host-to-device copies are non-blocking (the
+    loaders use pinned memory) and, on CUDA, issued on a side stream."""
+    def __init__(self, loader, num_prefetch=2, return_fname=False, start=0):
+        super(PrefetchInputFetcher, self).__init__(loader, start)
+        self.return_fname = return_fname
+        self.queue = queue.Queue(maxsize=num_prefetch)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._prefetch, daemon=True)
+        self.thread.start()
+
+    def _to_device(self, idx, x, attr, fname):
+        attr = attr.to(self.device, non_blocking=True)
+        inputs = Munch(index=idx.to(self.device, non_blocking=True),
+                       x=x.to(self.device, non_blocking=True),
+                       y=attr[:, 0],
+                       bias_label=attr[:, 1])
+        if self.return_fname:
+            inputs.fname = fname
+        return inputs
+
+    def _prefetch(self):
+        try:
+            if self.device.type == 'cuda':
+                torch.cuda.set_device(self.device) # New threads start on cuda:0
+            while not self.stop.is_set():
+                idx, x, attr, fname = self._fetch()
+                event = None
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        inputs = self._to_device(idx, x, attr, fname)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                else:
+                    inputs = self._to_device(idx, x, attr, fname)
+                self._put((inputs, event))
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __next__(self):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        self.consumed += 1
+        inputs, event = item
+        if event is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_event(event)
+            for v in inputs.values():
+                if torch.is_tensor(v):
+                    v.record_stream(current_stream)
+        return inputs
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
@@ -1,14 +1,18 @@
 import os
 import torch
 from torch.utils.data.dataset import Dataset
-from glob import glob
+from torchvision import transforms as T
 from PIL import Image
 import pandas as pd
 import numpy as np
 
+from data.memmap import MemmapImageStore, memmap_dir
+from data.manifest import load_file_index
+
 
 class CMNISTDataset(Dataset):
-    def __init__(self, root, name='cmnist', split='train', transform=None, conflict_pct=5):
+    def __init__(self, root, name='cmnist', split='train', transform=None, conflict_pct=5,
+                 use_memmap=False):
         super(CMNISTDataset, self).__init__()
         self.name = name
         self.transform = transform
@@ -16,33 +20,47 @@ class CMNISTDataset(Dataset):
         if conflict_pct >= 1:
             conflict_pct = int(conflict_pct)
         self.conflict_token = f'{conflict_pct}pct'
-
-        if split=='train':
-            self.header_dir = os.path.join(root, self.name, self.conflict_token)
-            self.align = glob(os.path.join(self.header_dir, 'align', "*", "*"))
-            self.conflict = glob(os.path.join(self.header_dir, 'conflict',"*", "*"))
-
-            self.data = self.align + self.conflict
-
-            train_target_attr = []
-            for data in self.data:
-                fname = os.path.relpath(data, self.header_dir)
-                train_target_attr.append(int(fname.split('_')[-2]))
-            self.y_array = torch.LongTensor(train_target_attr)
-
+        self.store = None
+
+        if use_memmap:
+            self.store = MemmapImageStore(os.path.join(memmap_dir(root, name),
+                                                       self.split_key(split)))
+            self.data = self.store.fnames
+            attrs = self.store.attrs
+        else:
+            # Cached glob + label parsing, see data/manifest.py
+            self.data, attrs = load_file_index(os.path.join(root, self.name),
+                                               self.file_patterns(split),
+                                               os.path.join(root, self.name, 'manifest',
+                                                            f'{self.split_key(split)}.npz'))
+        self.attr_array = torch.from_numpy(attrs)
+        if split == 'train':
+            self.y_array = self.attr_array[:, 0]
+
+    def file_patterns(self, split):
+        if split == 'train':
+            return [os.path.join(self.conflict_token, 'align', "*", "*"),
+                    os.path.join(self.conflict_token, 'conflict', "*", "*")]
         elif split == 'valid':
-            self.header_dir = os.path.join(root, self.name, self.conflict_token)
-            self.data = glob(os.path.join(self.header_dir, 'valid',"*","*"))
+            return [os.path.join(self.conflict_token, 'valid', "*", "*")]
+        elif split == 'test':
+            return [os.path.join('test', "*", "*")]
 
-        elif split=='test':
-            self.data = glob(os.path.join(root, self.name, 'test',"*","*"))
+    def split_key(self, split):
+        return 'test' if split == 'test' else f'{self.conflict_token}_{split}'
 
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, index):
-        attr = torch.LongTensor([int(self.data[index].split('_')[-2]),int(self.data[index].split('_')[-1].split('.')[0])])
-        image = Image.open(self.data[index]).convert('RGB')
+        attr = self.attr_array[index]
+        if self.store is not None and isinstance(self.transform, T.PILToTensor):
+            # --batch_transform: the collated batch is the only copy of the image
+            return self.store.tensor(index), attr, self.data[index]
+        if self.store is not None:
+            image = Image.fromarray(self.store.images[index])
+        else:
+            image = Image.open(self.data[index]).convert('RGB')
 
         if self.transform is not None:
             image = self.transform(image)
@@ -55,7 +73,8 @@ class CelebADataset(Dataset):
     CelebA dataset (already cropped and centered).
     NOTE: metadata_df is one-indexed.
     """
-    def __init__(self, root, name='celebA', split='train', transform=None, conflict_pct=5):
+    def __init__(self, root, name='celebA', split='train', transform=None, conflict_pct=5,
+                 use_memmap=False):
         self.name = name
         self.transform = transform
         self.root = root
@@ -67,6 +86,17 @@ class CelebADataset(Dataset):
 
         self.header_dir = os.path.join(root, self.name)
         self.data_dir = os.path.join(self.header_dir, "celeba", "img_align_celeba")
+        self.split_token = 0 if split == "train" else 2
+        self.store = None
+
+        if use_memmap:
+            self.store = MemmapImageStore(os.path.join(memmap_dir(root, name),
+                                                       self.split_key(split)))
+            self.filename_array = np.array(self.store.fnames)
+            self.attr_array = torch.from_numpy(self.store.attrs)
+            self.y_array = self.attr_array[:, 0]
+            self.confounder_array = self.attr_array[:, 1]
+            return
 
         print(f"Reading '{os.path.join(self.header_dir, 'metadata_blonde_subsampled.csv')}'")
         self.attrs_df = pd.read_csv(os.path.join(self.header_dir, "metadata_blonde_subsampled.csv"))
@@ -85,7 +115,6 @@ class CelebADataset(Dataset):
         confounder_idx = self.attr_idx('Male')
         self.confounder_array = self.attrs_df[:, confounder_idx]
 
-        self.split_token = 0 if split == "train" else 2
         mask = self.split_array == self.split_token
 
         num_split = np.sum(mask)
@@ -94,21 +123,32 @@ class CelebADataset(Dataset):
         self.filename_array = self.filename_array[indices]
         self.y_array = torch.tensor(self.y_array[indices]).long()
         self.confounder_array = torch.tensor(self.confounder_array[indices]).long()
+        self.attr_array = torch.stack([self.y_array, self.confounder_array], dim=1)
         self.indices = indices
 
 
     def attr_idx(self, attr_name):
         return self.attr_names.get_loc(attr_name)
 
+    def split_key(self, split):
+        return 'train' if self.split_token == 0 else 'test'
+
     def __len__(self):
         return len(self.y_array)
 
     def __getitem__(self, index):
-        attr = torch.LongTensor([int(self.y_array[index]), int(self.confounder_array[index])])
-
-        img_filename = os.path.join(self.data_dir,
-                                    self.filename_array[index])
-        image = Image.open(img_filename).convert("RGB")
+        attr = self.attr_array[index]
+
+        if self.store is not None and isinstance(self.transform, T.PILToTensor):
+            # --batch_transform: the collated batch is the only copy of the image
+            return self.store.tensor(index), attr, self.store.fnames[index]
+        if self.store is not None:
+            img_filename = self.store.fnames[index]
+            image = Image.fromarray(self.store.images[index])
+        else:
+            img_filename = os.path.join(self.data_dir,
+                                        self.filename_array[index])
+            image = Image.open(img_filename).convert("RGB")
 
         if self.transform is not None:
             image = self.transform(image)
@@ -116,17 +156,23 @@ class CelebADataset(Dataset):
         return image, attr, img_filename
 
 class CIFAR10Dataset(CMNISTDataset):
-    def __init__(self, root, name='cifar10c', split='train', transform=None, conflict_pct=5):
-        super(CIFAR10Dataset, self).__init__(root, name, split, transform, conflict_pct)
+    def __init__(self, root, name='cifar10c', split='train', transform=None, conflict_pct=5,
+                 use_memmap=False):
+        super(CIFAR10Dataset, self).__init__(root, name, split, transform, conflict_pct, use_memmap)
 
 class bFFHQDataset(CMNISTDataset):
-    def __init__(self, root, name='bffhq', split='train', transform=None, conflict_pct=5):
-        super(bFFHQDataset, self).__init__(root, name, split, transform, conflict_pct)
-        if split=='test':
-            self.data = glob(os.path.join(root, self.name, 'test', "*"))
-
-        elif split=='valid':
-            self.data = glob(os.path.join(root, self.name, 'valid', "*"))
+    def __init__(self, root, name='bffhq', split='train', transform=None, conflict_pct=5,
+                 use_memmap=False):
+        super(bFFHQDataset, self).__init__(root, name, split, transform, conflict_pct, use_memmap)
+
+    def file_patterns(self, split):
+        if split in ['valid', 'test']:
+            return [os.path.join(split, "*")]
+        return super(bFFHQDataset, self).file_patterns(split)
+
+    def split_key(self, split):
+        # valid/test splits of bffhq do not depend on the conflict ratio
+        return split if split != 'train' else f'{self.conflict_token}_train'
 
 class IdxDataset(Dataset):
     def __init__(self, dataset):
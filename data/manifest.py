@@ -0,0 +1,57 @@
+import os
+import json
+from glob import glob
+import numpy as np
+
+from util.storage import atomic_save
+
+
+def _parse_attr(path):
+    # {name}_{class_label}_{bias_label}.png
+    tokens = os.path.basename(path).split('_')
+    return int(tokens[-2]), int(tokens[-1].split('.')[0])
+
+
+def _fingerprint(header_dir, patterns):
+    """mtime of every directory visited by `patterns`. Adding or removing a file
+    changes the mtime of its parent directory, so this is enough to invalidate."""
+    fingerprint = {}
+    for pattern in patterns:
+        parent = os.path.dirname(os.path.join(header_dir, pattern))
+        dirs = glob(parent)
+        if '*' in parent:
+            dirs.append(os.path.dirname(parent))
+        for d in dirs:
+            if os.path.isdir(d):
+                fingerprint[os.path.relpath(d, header_dir)] = os.stat(d).st_mtime_ns
+    return fingerprint
+
+
+def load_file_index(header_dir, patterns, manifest_path):
+    """Return (paths, attrs) of the files matching `patterns` under `header_dir`.
+
+    The index is persisted in `manifest_path` and rebuilt only when the mtime of a
+    scanned directory changes. File order is the glob order, so sample indices (e.g.
+    in wrong_index.pth) stay the same as without the manifest.
+    """
+    fingerprint = _fingerprint(header_dir, patterns)
+    if os.path.exists(manifest_path):
+        manifest = np.load(manifest_path)
+        if json.loads(str(manifest['fingerprint'])) == fingerprint:
+            paths = [os.path.join(header_dir, p) for p in manifest['paths'].tolist()]
+            return paths, manifest['attrs']
+
+    paths = []
+    for pattern in patterns:
+        paths += glob(os.path.join(header_dir, pattern))
+    attrs = np.array([_parse_attr(p) for p in paths], dtype=np.int64).reshape(-1, 2)
+
+    try:
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        atomic_save(manifest_path, lambda tmp: np.savez(
+            tmp, paths=np.array([os.path.relpath(p, header_dir) for p in paths]),
+            attrs=attrs, fingerprint=np.array(json.dumps(fingerprint))))
+    except OSError as e:
+        print(f'WARNING: could not write file index {manifest_path}: {e}')
+
+    return paths, attrs
@@ -0,0 +1,65 @@
+import os
+import numpy as np
+import torch
+
+from util.storage import atomic_save, LazyMemmap
+
+
+def memmap_dir(root, name):
+    return os.path.join(root, name, 'memmap')
+
+
+class MemmapImageStore(LazyMemmap):
+    """Pre-decoded split: uint8 images [N, H, W, 3], attrs [N, 2] and file names.
+
+    Workers map the images instead of decoding them. The mapping is copy-on-write only to
+    be writable for torch.from_numpy; nothing writes it.
+    """
+    mmap_mode = 'c'
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        for suffix in ['images', 'attrs', 'fnames']:
+            if not os.path.exists(f'{prefix}_{suffix}.npy'):
+                raise FileNotFoundError(f'{prefix}_{suffix}.npy does not exist. '
+                                        'Run `python -m data.build_memmap` first.')
+        self.attrs = np.load(f'{prefix}_attrs.npy')
+        self.fnames = np.load(f'{prefix}_fnames.npy').tolist()
+
+    @property
+    def images(self):
+        return self.mapped(f'{self.prefix}_images.npy')
+
+    def tensor(self, index):
+        # uint8 [3, H, W] view of the mapping, as T.PILToTensor would return, without a copy
+        return torch.from_numpy(self.images[index]).permute(2, 0, 1)
+
+    def __len__(self):
+        return len(self.attrs)
+
+
+def pack_dataset(dataset, prefix):
+    """Decode every image of `dataset` (built with transform=None) once into `prefix`_*.npy."""
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    num = len(dataset)
+    first = np.asarray(dataset[0][0], dtype=np.uint8)
+
+    def write(tmp):
+        images = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8, shape=(num, *first.shape))
+        attrs = np.zeros((num, 2), dtype=np.int64)
+        fnames = []
+        for i in range(num):
+            image, attr, fname = dataset[i]
+            image = np.asarray(image, dtype=np.uint8)
+            if image.shape != first.shape:
+                raise ValueError(f'{fname} has shape {image.shape}, expected {first.shape}')
+            images[i] = image
+            attrs[i] = np.asarray(attr)
+            fnames.append(fname)
+        images.flush()
+        del images
+        # The store only exists once the images are renamed, after these
+        np.save(f'{prefix}_attrs.npy', attrs)
+        np.save(f'{prefix}_fnames.npy', np.array(fnames))
+    atomic_save(f'{prefix}_images.npy', write)
+    print(f'Packed {num} images of shape {first.shape} into {prefix}_images.npy')
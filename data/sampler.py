@@ -0,0 +1,121 @@
+import math
+import zlib
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler, DistributedSampler
+
+
+def mixed_seed(seed, salt, counter):
+    """Seed of draw `counter` of the loader named `salt`. Hashed, so that nearby seeds,
+    counters or loaders give unrelated streams (unlike seed + counter)."""
+    salt = zlib.crc32(salt.encode())
+    return int(np.random.SeedSequence([seed, salt, counter]).generate_state(1)[0])
+
+
+def seeded_generator(seed, salt, counter=0):
+    return torch.Generator().manual_seed(mixed_seed(seed, salt, counter))
+
+
+class EpochSampler(Sampler):
+    """Sampler whose order is a function of (seed, epoch), with the epoch advancing at every
+    iteration. resume() positions it after the first `num_batches` batches of the stream,
+    so that a resumed run loads the same batches as an uninterrupted one."""
+    epoch = 0
+    start = 0
+
+    def _indices(self):
+        raise NotImplementedError
+
+    def __iter__(self):
+        indices = self._indices()
+        self.epoch += 1
+        start, self.start = self.start, 0
+        return iter(indices[start:])
+
+    def resume(self, num_batches, batch_size):
+        self.epoch, start = divmod(num_batches, math.ceil(len(self) / batch_size))
+        self.start = start * batch_size
+
+
+class EpochRandomSampler(EpochSampler):
+    """RandomSampler with a permutation seeded by (seed, salt, epoch)"""
+    def __init__(self, num_samples, seed=0, salt=''):
+        self.num_samples = num_samples
+        self.seed, self.salt = seed, salt
+
+    def __len__(self):
+        return self.num_samples
+
+    def _indices(self):
+        generator = seeded_generator(self.seed, self.salt, self.epoch)
+        return torch.randperm(self.num_samples, generator=generator).tolist()
+
+
+class InfiniteWeightedSampler(Sampler):
+    """Endless stream of indices drawn with replacement from `weights`.
+
+    Every consecutive `batch_size` indices follow the same distribution as one epoch of
+    WeightedRandomSampler(weights, batch_size, replacement=True), but the iterator never
+    ends, so the DataLoader forks its workers only once. The indices of step k are drawn
+    with a generator seeded by (seed, salt, k).
+    With 2-D `weights` [K, N], every step draws `batch_size` indices from each row in turn
+    (K * batch_size in total), e.g. one batch per replica in ReplicaPruneSolver.
+    With `num_shards` > 1, every step draws the whole batch (alike in all processes) and
+    yields the `batch_size // num_shards` indices of shard `rank`.
+    """
+    def __init__(self, weights, batch_size, seed=0, rank=0, num_shards=1, salt=''):
+        self.weights = torch.as_tensor(weights, dtype=torch.double).cpu()
+        self.batch_size = batch_size
+        self.seed, self.salt = seed, salt
+        self.rank, self.num_shards = rank, num_shards
+        self.step = 0
+
+    def __iter__(self):
+        shard = self.batch_size // self.num_shards
+        while True:
+            generator = seeded_generator(self.seed, self.salt, self.step)
+            self.step += 1
+            indices = torch.multinomial(self.weights, self.batch_size, True, generator=generator)
+            if self.num_shards > 1:
+                indices = indices.view(-1, self.num_shards, shard)[:, self.rank]
+            yield from indices.flatten().tolist()
+
+    def resume(self, num_batches, batch_size):
+        self.step = num_batches
+
+
+class DistributedWeightedSampler(EpochSampler):
+    """Shard `rank` of WeightedRandomSampler(weights, num_samples, replacement=True).
+
+    Every epoch draws all `num_samples` indices with a generator seeded by (seed, salt, epoch),
+    the same in all processes, and yields the `num_samples // num_shards` of shard `rank`.
+    The epoch advances at every iteration.
+    """
+    def __init__(self, weights, num_samples, rank=0, num_shards=1, seed=0, salt=''):
+        self.weights = torch.as_tensor(weights, dtype=torch.double).cpu()
+        self.num_samples = num_samples
+        self.rank, self.num_shards = rank, num_shards
+        self.seed, self.salt = seed, salt
+
+    def __len__(self):
+        return self.num_samples // self.num_shards
+
+    def _indices(self):
+        generator = seeded_generator(self.seed, self.salt, self.epoch)
+        indices = torch.multinomial(self.weights, self.num_samples, True, generator=generator)
+        return indices[self.rank::self.num_shards][:len(self)].tolist()
+
+
+class EpochDistributedSampler(EpochSampler, DistributedSampler):
+    """DistributedSampler that reshuffles at every iteration, without set_epoch(), with
+    permutations seeded by (seed, salt, epoch)"""
+    def __init__(self, dataset, num_replicas, rank, seed=0, salt=''):
+        super(EpochDistributedSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank, seed=seed)
+        self.salt = salt
+
+    def _indices(self):
+        generator = seeded_generator(self.seed, self.salt, self.epoch)
+        indices = torch.randperm(len(self.dataset), generator=generator).tolist()
+        indices += indices[:self.total_size - len(indices)] # Pad to a multiple of num_replicas
+        return indices[self.rank:self.total_size:self.num_replicas]
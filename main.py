@@ -1,4 +1,5 @@
 import os
+import copy
 import argparse
 
 from munch import Munch
@@ -6,24 +7,47 @@ from torch.backends import cudnn
 import torch
 
 from training.pruning_solver import PruneSolver
-from util import setup, save_config, modify_args_for_baselines
+from training.replica_solver import ReplicaPruneSolver
+from model.build_models import classifier_class
+from prune.Compact import supports_compaction
+from util import setup, save_config, modify_args_for_baselines, distributed
 
 
 def main(args):
+    distributed.init_distributed()
     print(args)
-    args = setup(args) # Making folders following exp_name
-    save_config(args)
-    cudnn.benchmark = True
-    torch.manual_seed(args.seed)
-
-    solver = PruneSolver(args)
-
-    if args.phase == 'train':
-        solver.train()
+    if args.seeds and len(args.seeds) > 1:
+        # One run per seed, trained together. Each run keeps its own folders
+        replica_args = []
+        for seed in args.seeds:
+            replica = copy.copy(args)
+            replica.seed = seed
+            replica_args.append(setup(replica))
+            save_config(replica)
+        args = copy.copy(replica_args[0])
+        cudnn.benchmark = True
+        torch.manual_seed(args.seed)
+        solver = ReplicaPruneSolver(args, replica_args)
     else:
-        solver.evaluate()
-
-if __name__ == '__main__':
+        if args.seeds:
+            args.seed = args.seeds[0]
+        args = setup(args) # Making folders following exp_name
+        if distributed.is_main_process():
+            save_config(args)
+        cudnn.benchmark = True
+        torch.manual_seed(args.seed)
+        solver = PruneSolver(args)
+
+    try:
+        if args.phase == 'train':
+            solver.train()
+        else:
+            solver.evaluate()
+    finally:
+        solver.close()
+    distributed.cleanup()
+
+def get_parser():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--mode', type=str, required=True,
@@ -33,14 +57,25 @@ if __name__ == '__main__':
     parser.add_argument('--data', type=str, default='cmnist',
                         choices=['cmnist', 'cifar10c', 'bffhq', 'celebA'])
     parser.add_argument('--cmnist_use_mlp', default=False, action='store_true')
+    parser.add_argument('--low_pass', default=False, action='store_true',
+                        help='Never prune conv1 and layer1 of the ResNet18 (not cmnist)')
     parser.add_argument('--conflict_pct', type=float, default=5., choices=[0.5, 1., 2., 5.],
                         help='Percent of bias-conflicting data')
     parser.add_argument('--phase', type=str, default='train',
                         choices=['train', 'test'])
+    parser.add_argument('--stop_after', type=str, default=None,
+                        choices=['pretrain', 'mine', 'prune'],
+                        help='End training once the checkpoint of this stage exists (used by sweep.py)')
+    parser.add_argument('--use_memmap', default=False, action='store_true',
+                        help='Read pre-decoded images built by `python -m data.build_memmap`')
 
     # weight for objective functions
     parser.add_argument('--lambda_con_prune', type=float, default=0.05)
     parser.add_argument('--lambda_con_retrain', type=float, default=0.05)
+    parser.add_argument('--con_chunk_size', type=int, default=0,
+                        help='Compute the contrastive loss in blocks of this many anchors (0: dense)')
+    parser.add_argument('--memory_bank_size', type=int, default=0,
+                        help='Number of recent features also used as contrastive samples (0: batch only)')
     parser.add_argument('--lambda_sparse', type=float, default=1e-8)
     parser.add_argument('--lambda_upweight', type=float, default=20)
 
@@ -85,8 +120,38 @@ if __name__ == '__main__':
     # misc
     parser.add_argument('--num_workers', type=int, default=4,
                         help='Number of workers used in DataLoader')
+    parser.add_argument('--stream_sampling', default=False, action='store_true',
+                        help='Draw upweighted batches from an infinite sampler with persistent workers')
+    parser.add_argument('--batch_transform', default=False, action='store_true',
+                        help='Augment collated uint8 batches instead of single PIL images')
+    parser.add_argument('--num_prefetch', type=int, default=0,
+                        help='Number of training batches loaded ahead by a background thread (0: off)')
+    parser.add_argument('--nan_check_every', type=int, default=1,
+                        help='Check the GCE loss for NaN every this many steps (fewer host synchronizations)')
+    parser.add_argument('--amp', default=False, action='store_true',
+                        help='Train and evaluate under bf16 autocast')
+    parser.add_argument('--compile', default=False, action='store_true',
+                        help='Run the networks through torch.compile, one graph per pruning/freeze phase')
+    parser.add_argument('--fused_mask', default=False, action='store_true',
+                        help='Keep all pruning masks in one flat buffer and sample them together')
+    parser.add_argument('--mask_in_place', default=False, action='store_true',
+                        help='Zero pruned weights once before retraining instead of masking every forward')
+    parser.add_argument('--activation_cache', type=str, default=None, choices=['ram', 'memmap'],
+                        help='With --low_pass, learn masks on cached outputs of the unpruned prefix')
+    parser.add_argument('--compact', default=False, action='store_true',
+                        help='In test phase, also save the pruned classifier with dead channels removed')
+    parser.add_argument('--sparse_inference', default=False, action='store_true',
+                        help='In test phase, also save a CPU model running sparse layers as CSR matmuls')
+    parser.add_argument('--sparse_max_density', type=float, default=0.5,
+                        help='Layers denser than this always stay dense')
+    parser.add_argument('--export_pruned', default=False, action='store_true',
+                        help='Export the retrained classifier with bit-packed masks and load it in test phase')
+    parser.add_argument('--export_dtype', type=str, default='float32',
+                        choices=['float32', 'float16', 'bfloat16'])
     parser.add_argument('--seed', type=int, default=7777,
                         help='Seed for random number generator')
+    parser.add_argument('--seeds', type=int, nargs='+', default=None,
+                        help='Train one run per seed in a single process (cmnist GateCNN only)')
     parser.add_argument('--imagenet', default=True, action='store_true')
     parser.add_argument('--supervised', default=False, action='store_true',
                         help='Use true bias label or not')
@@ -94,6 +159,8 @@ if __name__ == '__main__':
                         choices=['wrong', 'ensemble'], default='ensemble')
     parser.add_argument('--eta', type=float, default=0.05)
     parser.add_argument('--tau', type=float, default=0.8)
+    parser.add_argument('--mine_topk', type=int, default=None,
+                        help='Mine the samples of the k highest bias scores instead of the rule of --pseudo_label_method')
 
 
     # directory for training
@@ -112,9 +179,30 @@ if __name__ == '__main__':
     parser.add_argument('--save_every', type=int, default=1000)
     parser.add_argument('--eval_every', type=int, default=500)
     parser.add_argument('--save_every_retrain', type=int, default=1000)
+    parser.add_argument('--async_checkpoint', default=False, action='store_true',
+                        help='Write checkpoints from a background thread')
+    parser.add_argument('--max_pending_ckpt', type=int, default=2,
+                        help='Checkpoints waiting to be written before saving blocks (--async_checkpoint)')
+    parser.add_argument('--keep_last_ckpt', type=int, default=None,
+                        help='Keep only the last N checkpoints of each phase, besides those loaded later')
+    parser.add_argument('--save_state_every', type=int, default=0,
+                        help='Save the full training state every this many steps of a phase (0: off). '
+                             'An interrupted phase resumes from its last state')
     parser.add_argument('--eval_every_retrain', type=int, default=100)
+    return parser
+
+def check_args(parser, args):
+    # Options that would otherwise only fail at the end of a run
+    if args.compact:
+        single = copy.copy(args)
+        single.seeds = None # Runs of --seeds are tested and compacted one by one
+        if not supports_compaction(classifier_class(single)):
+            parser.error(f'--compact does not support {classifier_class(single).__name__}')
 
+if __name__ == '__main__':
+    parser = get_parser()
     args = parser.parse_args()
+    check_args(parser, args)
     args = modify_args_for_baselines(args)
 
     main(args)
@@ -4,23 +4,36 @@ from model.simple_model import CNN, MLP, FC
 from model.resnet import ResNet18, ResNet34
 from model.wide_resnet import WideResNet28_10, WideResNet16_8
 
-from prune.GateSimpleModel import GateCNN, GateFCN
-from prune.GateResnet import GateResNet18, GateResNet34, LowPassGateResNet18
+from prune.GateSimpleModel import GateCNN, GateFCN, GroupedGateCNN
+from prune.GateResnet import GateResNet18, GateResNet34, LowPassGateResNet18, ResNet, LowPassResNet
 from prune.GateWideResnet import GateWideResNet28_10, GateWideResNet16_8
 
 from data.transforms import num_classes
 
+def classifier_class(args):
+    # Class of build_model(args).classifier, without building it
+    if args.data == 'cmnist' and args.seeds and len(args.seeds) > 1:
+        return GroupedGateCNN
+    elif args.data == 'cmnist':
+        return GateCNN if not args.cmnist_use_mlp else GateFCN
+    return LowPassResNet if args.low_pass else ResNet
+
 def build_model(args):
     n_classes = num_classes[args.data]
     if args.mode in ['prune', 'JTT', 'MRM', 'ERM']: # ERM is included for coding consistency. pruning X
-        if args.data == 'cmnist':
+        if args.data == 'cmnist' and args.seeds and len(args.seeds) > 1:
+            # One network holding a replica per seed (training/replica_solver.py)
+            nets = Munch(classifier=GroupedGateCNN(len(args.seeds)),
+                         biased_classifier=GroupedGateCNN(len(args.seeds)))
+        elif args.data == 'cmnist':
             classifier = GateCNN() if not args.cmnist_use_mlp else GateFCN()
             biased_classifier = GateCNN() if not args.cmnist_use_mlp else GateFCN()
             nets = Munch(classifier=classifier,
                          biased_classifier=biased_classifier)
         else:
-            classifier = GateResNet18(IMAGENET_pretrained=args.imagenet, n_classes=n_classes)
-            biased_classifier = GateResNet18(IMAGENET_pretrained=args.imagenet, n_classes=n_classes)
+            gate_resnet = LowPassGateResNet18 if args.low_pass else GateResNet18
+            classifier = gate_resnet(IMAGENET_pretrained=args.imagenet, n_classes=n_classes)
+            biased_classifier = gate_resnet(IMAGENET_pretrained=args.imagenet, n_classes=n_classes)
             nets = Munch(classifier=classifier,
                          biased_classifier=biased_classifier)
         return nets
@@ -0,0 +1,183 @@
+"""Structured compaction of frozen Gate networks into smaller dense networks.
+
+Every GateConv2d/GateMLP is replaced by a plain layer holding its masked weight, then the
+channels (neurons) between a layer and the next one are physically removed when
+  - the consumer never reads them (its masked weight is zero for that input), or
+  - the producer never writes them (masked weight is zero for that output): the channel
+    is then the constant relu(bn(bias)), which is folded into the consumer's bias when
+    that is exact (zero constant, Linear consumer, or unpadded convolution).
+Only internal channels are compacted; residual streams, the network input and the
+classifier output keep their width (so do the features of GateCNN/GateFCN when the final
+Linear reads all of them). BatchNorm uses running statistics, so the compact network is
+meant for inference and is returned in eval mode.
+"""
+import copy
+
+import torch
+import torch.nn as nn
+
+from prune.GateLayer import GateMixin
+from prune.GateSimpleModel import GateCNN, GateFCN
+from prune.GateResnet import ResNet, Bottleneck
+from prune.GateWideResnet import GateWideResNet
+
+
+class CompactConv2d(nn.Conv2d):
+    """nn.Conv2d accepting (and ignoring) the pruning/freeze flags passed by Gate models"""
+    def forward(self, input, pruning=False, freeze=False):
+        return super(CompactConv2d, self).forward(input)
+
+
+class CompactLinear(nn.Linear):
+    def forward(self, input, pruning=False, freeze=False):
+        return super(CompactLinear, self).forward(input)
+
+
+def supports_compaction(model_class):
+    return issubclass(model_class, (GateCNN, GateFCN, ResNet, GateWideResNet))
+
+
+def _channel_chains(model):
+    # (producer, batchnorm or None, consumer), each followed by a relu in the forward
+    if isinstance(model, GateCNN):
+        return [(model.conv1, model.bn1, model.conv2),
+                (model.conv2, model.bn2, model.conv3),
+                (model.conv3, model.bn3, model.linear)]
+    if isinstance(model, GateFCN):
+        return [(model.linear1, None, model.linear2),
+                (model.linear2, None, model.linear3),
+                (model.linear3, None, model.linear4)]
+    if isinstance(model, ResNet):
+        chains = []
+        for layer in [model.layer1, model.layer2, model.layer3, model.layer4]:
+            for block in layer:
+                chains.append((block.conv1, block.bn1, block.conv2))
+                if isinstance(block, Bottleneck):
+                    chains.append((block.conv2, block.bn2, block.conv3))
+        return chains
+    if isinstance(model, GateWideResNet):
+        return [(block.conv1, block.bn2, block.conv2)
+                for network_block in [model.block1, model.block2, model.block3]
+                for block in network_block.layer]
+    raise TypeError(f'Compaction is not supported for {type(model).__name__}')
+
+
+def masked_layers(model, example_input):
+    """Gate layers whose frozen mask is applied in a forward. Some layers (e.g. the
+    unpruned stem of LowPassResNet) are called without the freeze flag."""
+    masked = set()
+
+    def hook(module, args):
+        if len(args) > 2 and args[2]:
+            masked.add(module)
+
+    handles = [m.register_forward_pre_hook(hook) for m in model.modules() if isinstance(m, GateMixin)]
+    with torch.no_grad():
+        model(example_input)
+    for h in handles:
+        h.remove()
+    return masked
+
+
+def _to_plain(layer, masked):
+    weight = layer.weight.detach()
+    if masked:
+        weight = weight * layer.mask.fix_mask_after_pruning().to(weight.device)
+    if isinstance(layer, nn.Conv2d):
+        plain = CompactConv2d(layer.in_channels, layer.out_channels, layer.kernel_size,
+                              stride=layer.stride, padding=layer.padding, dilation=layer.dilation,
+                              groups=layer.groups, bias=layer.bias is not None,
+                              padding_mode=layer.padding_mode)
+    else:
+        plain = CompactLinear(layer.in_features, layer.out_features, bias=layer.bias is not None)
+    plain = plain.to(device=weight.device, dtype=weight.dtype)
+    plain.weight.data.copy_(weight)
+    if layer.bias is not None:
+        plain.bias.data.copy_(layer.bias.detach())
+    return plain
+
+
+def replace_modules(model, replace):
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module._modules.items()):
+            if child in replace:
+                module._modules[child_name] = replace[child]
+
+
+def _slice_out(layer, keep):
+    layer.weight = nn.Parameter(layer.weight.data[keep].clone())
+    if layer.bias is not None:
+        layer.bias = nn.Parameter(layer.bias.data[keep].clone())
+    if isinstance(layer, nn.Conv2d):
+        layer.out_channels = len(keep)
+    else:
+        layer.out_features = len(keep)
+
+
+def _slice_in(layer, keep):
+    layer.weight = nn.Parameter(layer.weight.data[:, keep].clone())
+    if isinstance(layer, nn.Conv2d):
+        layer.in_channels = len(keep)
+    else:
+        layer.in_features = len(keep)
+
+
+def _slice_bn(bn, keep):
+    bn.weight = nn.Parameter(bn.weight.data[keep].clone())
+    bn.bias = nn.Parameter(bn.bias.data[keep].clone())
+    bn.running_mean = bn.running_mean[keep].clone()
+    bn.running_var = bn.running_var[keep].clone()
+    bn.num_features = len(keep)
+
+
+def _compact_chain(producer, bn, consumer):
+    with torch.no_grad():
+        dead = producer.weight.flatten(1).abs().sum(1) == 0
+        unused = consumer.weight.transpose(0, 1).flatten(1).abs().sum(1) == 0
+
+        # Value of a dead channel after bn and relu
+        const = producer.bias.clone() if producer.bias is not None else torch.zeros_like(dead, dtype=producer.weight.dtype)
+        if bn is not None:
+            const = (const - bn.running_mean) / torch.sqrt(bn.running_var + bn.eps) * bn.weight + bn.bias
+        const = const.clamp(min=0)
+        exact = isinstance(consumer, nn.Linear) or all(p == 0 for p in consumer.padding)
+        foldable = dead & ((const == 0) | exact)
+
+        remove = unused | foldable
+        if remove.all():
+            remove[0] = False # Keep at least one channel
+        fold = remove & ~unused & (const != 0)
+        if fold.any():
+            weight = consumer.weight[:, fold]
+            contribution = (weight.reshape(weight.size(0), weight.size(1), -1).sum(2) * const[fold]).sum(1)
+            if consumer.bias is None:
+                consumer.bias = nn.Parameter(contribution)
+            else:
+                consumer.bias.add_(contribution)
+
+        keep = (~remove).nonzero().squeeze(1)
+        _slice_out(producer, keep)
+        if bn is not None:
+            _slice_bn(bn, keep)
+        _slice_in(consumer, keep)
+
+
+def compact_model(model, example_input):
+    """Return a compacted copy of a frozen Gate network; `model` itself is left untouched.
+    `example_input` is a batch used to trace which layers apply their mask."""
+    model = copy.deepcopy(model).eval()
+    model.pruning_switch(False)
+    model.freeze_switch(True)
+
+    masked = masked_layers(model, example_input)
+    chains = _channel_chains(model)
+    plain = {m: _to_plain(m, m in masked) for m in model.modules() if isinstance(m, GateMixin)}
+    replace_modules(model, plain)
+
+    for producer, bn, consumer in chains:
+        _compact_chain(plain[producer], bn, plain[consumer])
+    return model
+
+
+def count_parameters(model):
+    return sum(p.numel() for n, p in model.named_parameters() if 'gumbel_pi' not in n)
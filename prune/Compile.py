@@ -0,0 +1,61 @@
+"""torch.compile for Gate networks, specialized to the (pruning, freeze) flags.
+
+compile_phases(model) routes the forward of `model` through one compiled function per
+phase. The models' pruning_switch/freeze_switch select the function of the new phase
+(building it on the first switch into that phase), so every phase is captured once with
+its flags as constants and no phase invalidates another's graph. When torch.compile is
+missing, or fails on the first call of a phase, that phase runs eagerly.
+"""
+import types
+import warnings
+
+import torch
+
+
+def is_compiling():
+    # torch.compiler only exists from torch 2.x on; nothing is ever compiled before
+    return getattr(getattr(torch, 'compiler', None), 'is_compiling', lambda: False)()
+
+
+class _CompiledForward(object):
+    def __init__(self, forward, compile_kwargs):
+        self.eager = forward
+        self.compiled = torch.compile(forward, **compile_kwargs) if hasattr(torch, 'compile') else None
+        self.checked = False
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is None:
+            return self.eager(*args, **kwargs)
+        if self.checked:
+            return self.compiled(*args, **kwargs)
+        try:
+            out = self.compiled(*args, **kwargs)
+        except Exception as e:
+            warnings.warn(f'torch.compile failed, running eagerly: {e}')
+            self.compiled = None
+            return self.eager(*args, **kwargs)
+        self.checked = True
+        return out
+
+
+def _phase_forward(self, *args, **kwargs):
+    return self._active_forward(self, *args, **kwargs)
+
+
+def compile_phases(model, **compile_kwargs):
+    """Compile the forward of `model` per phase. compile_kwargs go to torch.compile."""
+    model._compile_kwargs = compile_kwargs
+    model._phase_forwards = {}
+    # Unbound functions: copies of the model (e.g. copy.deepcopy) keep working on themselves
+    model.forward = types.MethodType(_phase_forward, model)
+    set_compiled_phase(model)
+    return model
+
+
+def set_compiled_phase(model):
+    if getattr(model, '_phase_forwards', None) is None:
+        return
+    phase = (model.pruning, model.freeze)
+    if phase not in model._phase_forwards:
+        model._phase_forwards[phase] = _CompiledForward(type(model).forward, model._compile_kwargs)
+    model._active_forward = model._phase_forwards[phase]
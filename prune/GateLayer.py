@@ -1,28 +1,75 @@
+import math
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
 from prune.GumbelSigmoid import GumbelSigmoidMask
+from prune.Compile import is_compiling
 
-class GateMLP(nn.Linear):
-    def __init__(self, in_features, out_features, bias=True, device=None, dtype=None):
-        super(GateMLP, self).__init__(in_features, out_features, bias=bias)
-        self.mask = GumbelSigmoidMask(self.weight.shape)
 
-    def forward(self, input, pruning=False, freeze=False):
+class GateMixin(object):
+    """Mask handling shared by GateMLP and GateConv2d.
+
+    With `mask_in_place` (set by the models' freeze_switch), the frozen mask is multiplied
+    into the weight once and a gradient hook keeps pruned weights at zero, so frozen
+    forwards use the weight as is. Loading a state dict re-applies the mask on the next
+    forward.
+    """
+    mask_in_place = False
+    _applied_mask = None
+    _grad_hook = None
+
+    def masked_weight(self, pruning=False, freeze=False):
         mask = None
         if pruning:
             mask = self.mask.sample(hard=True)
 
         if freeze:
             mask = self.mask.fix_mask_after_pruning()
+            if self.mask_in_place and not is_compiling(): # Compiled graphs fuse the product
+                self._apply_mask_in_place(mask)
+                mask = None
 
         if mask is not None:
-            return F.linear(input, self.weight*mask.to(input.device), self.bias)
-        else:
-            return F.linear(input, self.weight, self.bias)
+            return self.weight*mask.to(self.weight.device)
+        return self.weight
+
+    def _apply_mask_in_place(self, mask):
+        if mask is self._applied_mask:
+            return
+        with torch.no_grad():
+            self.weight.mul_(mask)
+        self._applied_mask = mask
+        if self._grad_hook is None:
+            self._grad_hook = self.weight.register_hook(self._mask_grad)
+
+    def _mask_grad(self, grad):
+        if self.mask_in_place and self._applied_mask is not None:
+            return grad * self._applied_mask
+        return grad
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._applied_mask = None
+        super(GateMixin, self)._load_from_state_dict(*args, **kwargs)
+
+
+def set_mask_in_place(model, turn_on=False):
+    for m in model.modules():
+        if isinstance(m, GateMixin):
+            m.mask_in_place = turn_on
+            if not turn_on:
+                m._applied_mask = None
+
+
+class GateMLP(GateMixin, nn.Linear):
+    def __init__(self, in_features, out_features, bias=True, device=None, dtype=None):
+        super(GateMLP, self).__init__(in_features, out_features, bias=bias)
+        self.mask = GumbelSigmoidMask(self.weight.shape)
 
+    def forward(self, input, pruning=False, freeze=False):
+        return F.linear(input, self.masked_weight(pruning, freeze), self.bias)
 
-class GateConv2d(nn.Conv2d):
+
+class GateConv2d(GateMixin, nn.Conv2d):
     def __init__(self, in_features, out_features, kernel_size=3, stride=1, padding=0, bias=True,
                  dilation=1, groups=1):
         super(GateConv2d, self).__init__(in_features, out_features, kernel_size,
@@ -31,17 +78,21 @@ class GateConv2d(nn.Conv2d):
         self.mask = GumbelSigmoidMask(self.weight.shape)
 
     def forward(self, input, pruning=False, freeze=False):
-        mask = None
-        if pruning:
-            mask = self.mask.sample(hard=True)
+        return F.conv2d(input, self.masked_weight(pruning, freeze), self.bias,
+                        self.stride, self.padding, self.dilation, self.groups)
 
-        if freeze:
-            mask = self.mask.fix_mask_after_pruning()
 
-        if mask is not None:
-            return F.conv2d(input, self.weight*mask.to(input.device), self.bias,
-                            self.stride, self.padding, self.dilation, self.groups)
-        else:
-            return F.conv2d(input, self.weight, self.bias,
-                            self.stride, self.padding, self.dilation, self.groups)
+class GroupedGateMLP(GateMixin, nn.Module):
+    """`num_groups` independent GateMLPs applied to input of shape [B, num_groups, in_features]"""
+    def __init__(self, num_groups, in_features, out_features):
+        super(GroupedGateMLP, self).__init__()
+        self.num_groups, self.in_features, self.out_features = num_groups, in_features, out_features
+        self.weight = nn.Parameter(torch.empty(num_groups, out_features, in_features))
+        self.bias = nn.Parameter(torch.empty(num_groups, out_features))
+        for k in range(num_groups): # As nn.Linear
+            nn.init.kaiming_uniform_(self.weight[k], a=math.sqrt(5))
+            nn.init.uniform_(self.bias[k], -1 / math.sqrt(in_features), 1 / math.sqrt(in_features))
+        self.mask = GumbelSigmoidMask(self.weight.shape)
 
+    def forward(self, input, pruning=False, freeze=False):
+        return torch.einsum('bki,koi->bko', input, self.masked_weight(pruning, freeze)) + self.bias
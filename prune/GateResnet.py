@@ -5,7 +5,8 @@ from torch import Tensor
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
-from prune.GateLayer import GateMLP, GateConv2d
+from prune.GateLayer import GateMLP, GateConv2d, set_mask_in_place
+from prune.Compile import set_compiled_phase
 from torch.utils.model_zoo import load_url
 import math
 
@@ -289,9 +290,12 @@ class ResNet(nn.Module):
 
     def pruning_switch(self, turn_on=False):
         self.pruning = turn_on
+        set_compiled_phase(self)
 
-    def freeze_switch(self, turn_on=False):
+    def freeze_switch(self, turn_on=False, in_place=False):
         self.freeze = turn_on
+        set_mask_in_place(self, turn_on and in_place)
+        set_compiled_phase(self)
 
 
 class LowPassResNet(ResNet):
@@ -310,15 +314,24 @@ class LowPassResNet(ResNet):
         super(LowPassResNet, self).__init__(block, layers, num_classes, zero_init_residual,
                                       groups, width_per_group, replace_stride_with_dilation,
                                       norm_layer)
+        self.cached_prefix = False
 
-    def _forward_impl(self, x: Tensor, pruning=False, freeze=False, feature=False) -> Tensor:
-        # See note [TorchScript super()]
+    def prefix(self, x: Tensor) -> Tensor:
+        # Unpruned layers: conv1 to layer1
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
         x = self.maxpool(x)
+        return self.layer_forward(self.layer1, x)
+
+    def cached_prefix_switch(self, turn_on=False):
+        # Inputs are prefix outputs (data/activation_cache.py) instead of images
+        self.cached_prefix = turn_on
 
-        x = self.layer_forward(self.layer1, x)
+    def _forward_impl(self, x: Tensor, pruning=False, freeze=False, feature=False) -> Tensor:
+        # See note [TorchScript super()]
+        if not self.cached_prefix:
+            x = self.prefix(x)
         x = self.layer_forward(self.layer2, x, pruning, freeze)
         x = self.layer_forward(self.layer3, x, pruning, freeze)
         x = self.layer_forward(self.layer4, x, pruning, freeze)
@@ -1,7 +1,8 @@
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
-from prune.GateLayer import GateMLP, GateConv2d
+from prune.GateLayer import GateMLP, GateConv2d, GroupedGateMLP, set_mask_in_place
+from prune.Compile import set_compiled_phase
 
 class GateCNN(nn.Module):
     # For cmnist only
@@ -47,9 +48,12 @@ class GateCNN(nn.Module):
 
     def pruning_switch(self, turn_on=False):
         self.pruning = turn_on
+        set_compiled_phase(self)
 
-    def freeze_switch(self, turn_on=False):
+    def freeze_switch(self, turn_on=False, in_place=False):
         self.freeze = turn_on
+        set_mask_in_place(self, turn_on and in_place)
+        set_compiled_phase(self)
 
     def prune_permanently(self):
         for m in self.modules():
@@ -97,9 +101,12 @@ class GateFCN(nn.Module):
 
     def pruning_switch(self, turn_on=False):
         self.pruning = turn_on
+        set_compiled_phase(self)
 
-    def freeze_switch(self, turn_on=False):
+    def freeze_switch(self, turn_on=False, in_place=False):
         self.freeze = turn_on
+        set_mask_in_place(self, turn_on and in_place)
+        set_compiled_phase(self)
 
     def prune_permanently(self):
         for m in self.modules():
@@ -107,3 +114,85 @@ class GateFCN(nn.Module):
                 mask = m.mask.fix_mask_after_pruning()
                 m.weight = m.weight*mask.to(m.weight.device)
         print('Prune out weights permanently')
+
+
+class GroupedGateCNN(nn.Module):
+    """`num_replicas` independent GateCNNs run as one network: convolutions are grouped
+    per replica, BatchNorm is per channel and the last layer is a GroupedGateMLP.
+    Input is [B, 3, H, W] (shared by all replicas) or [B, num_replicas, 3, H, W];
+    logits and features are [B, num_replicas, ...]."""
+    def __init__(self, num_replicas):
+        super().__init__()
+        self.pruning = False
+        self.freeze = False
+        self.num_replicas = k = num_replicas
+
+        self.conv1 = GateConv2d(3*k, 64*k, kernel_size=4, stride=2, padding=1, bias=False, groups=k)
+        self.bn1 = nn.BatchNorm2d(64*k)
+        self.conv2 = GateConv2d(64*k, 128*k, kernel_size=4, stride=2, padding=1, bias=False, groups=k)
+        self.bn2 = nn.BatchNorm2d(128*k)
+        self.conv3 = GateConv2d(128*k, 256*k, kernel_size=4, stride=2, padding=1, bias=False, groups=k)
+        self.bn3 = nn.BatchNorm2d(256*k)
+        self.relu = nn.ReLU()
+        self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
+        self.linear = GroupedGateMLP(k, 256, 10)
+
+    def forward(self, x, feature=False):
+        if x.dim() == 4:
+            x = x.repeat(1, self.num_replicas, 1, 1)
+        else:
+            x = x.flatten(1, 2)
+        out = self.conv1(x, self.pruning, self.freeze)
+        out = self.bn1(out)
+        out = self.relu(out)
+
+        out = self.conv2(out, self.pruning, self.freeze)
+        out = self.bn2(out)
+        out = self.relu(out)
+
+        out = self.conv3(out, self.pruning, self.freeze)
+        out = self.bn3(out)
+        out = self.relu(out)
+        out = self.avgpool(out)
+        feature_ = out.view(out.size(0), self.num_replicas, -1)
+        logit = self.linear(feature_, self.pruning, self.freeze)
+
+        if feature:
+            return logit, feature_
+        else:
+            return logit
+
+    def pruning_switch(self, turn_on=False):
+        self.pruning = turn_on
+        set_compiled_phase(self)
+
+    def freeze_switch(self, turn_on=False, in_place=False):
+        self.freeze = turn_on
+        set_mask_in_place(self, turn_on and in_place)
+        set_compiled_phase(self)
+
+    def load_replicas(self, state_dicts):
+        """Load one GateCNN state dict per replica"""
+        state = {}
+        for key, value in state_dicts[0].items():
+            values = [sd[key] for sd in state_dicts]
+            if key.startswith('linear.'):
+                state[key] = torch.stack(values)
+            elif value.dim() == 0:
+                state[key] = value # num_batches_tracked, shared by all replicas
+            else:
+                state[key] = torch.cat(values)
+        self.load_state_dict(state)
+
+    def replica_state_dicts(self):
+        """GateCNN state dict of every replica"""
+        state_dicts = [{} for _ in range(self.num_replicas)]
+        for key, value in self.state_dict().items():
+            for k in range(self.num_replicas):
+                if key.startswith('linear.'):
+                    state_dicts[k][key] = value[k].clone()
+                elif value.dim() == 0:
+                    state_dicts[k][key] = value.clone()
+                else:
+                    state_dicts[k][key] = value.chunk(self.num_replicas)[k].clone()
+        return state_dicts
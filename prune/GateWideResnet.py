@@ -2,7 +2,8 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from prune.GateLayer import GateMLP, GateConv2d
+from prune.GateLayer import GateMLP, GateConv2d, set_mask_in_place
+from prune.Compile import set_compiled_phase
 
 __all__ = ['wrn']
 
@@ -108,9 +109,12 @@ class GateWideResNet(nn.Module):
 
     def pruning_switch(self, turn_on=False):
         self.pruning = turn_on
+        set_compiled_phase(self)
 
-    def freeze_switch(self, turn_on=False):
+    def freeze_switch(self, turn_on=False, in_place=False):
         self.freeze = turn_on
+        set_mask_in_place(self, turn_on and in_place)
+        set_compiled_phase(self)
 
 
 def wrn(depth, num_classes, widen_factor=1, dropRate=0.):
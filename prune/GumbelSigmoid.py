@@ -2,13 +2,25 @@ import torch
 import torch.nn.functional as F
 import torch.nn as nn
 
+from prune.Compile import is_compiling
+
 class GumbelSigmoidMask(nn.Module):
     def __init__(self, mask_shape):
         super(GumbelSigmoidMask, self).__init__()
         self.sigmoid = nn.Sigmoid()
         self.gumbel_pi = nn.Parameter(1.5*torch.ones(mask_shape))
+        self.store = None # FlatMaskStore sharing gumbel_pi, if any
+        self._fixed_mask = None
+        self._fixed_key = None
 
     def sample(self, tau=1., eps=1e-10, hard=False, flip=False):
+        # Noise and thresholds stay in fp32 under autocast
+        with torch.autocast(self.gumbel_pi.device.type, enabled=False):
+            if self.store is not None and hard and not flip and tau == 1.:
+                return self.store.sample(self)
+            return self._sample(tau, eps, hard, flip)
+
+    def _sample(self, tau, eps, hard, flip):
         logits = self.sigmoid(self.gumbel_pi)
         if flip:
             logits = 1.-logits
@@ -22,7 +34,98 @@ class GumbelSigmoidMask(nn.Module):
         return res
 
     def fix_mask_after_pruning(self):
-        fixed_mask = torch.zeros_like(self.gumbel_pi)
-        fixed_mask[self.gumbel_pi >= 0] = 1.
-        return fixed_mask
+        # Cached until gumbel_pi is updated in place (optimizer step, load_state_dict) or replaced
+        pi = self.gumbel_pi
+        if is_compiling(): # Traced into the graph of the frozen phase instead
+            return (pi.detach() >= 0).to(pi.dtype)
+        key = (pi._version, pi.data_ptr(), pi.device, pi.dtype)
+        if self._fixed_key != key:
+            fixed_mask = torch.zeros_like(pi, requires_grad=False)
+            fixed_mask[pi.detach() >= 0] = 1.
+            self._fixed_mask, self._fixed_key = fixed_mask, key
+        return self._fixed_mask
+
+
+class _FlatView(torch.autograd.Function):
+    """Zero-copy concatenation of parameters that already view consecutive slices of
+    `flat`: returns `flat` itself and splits the incoming gradient back into views."""
+    @staticmethod
+    def forward(ctx, flat, *params):
+        ctx.shapes = [p.shape for p in params]
+        return flat.view(-1)
+
+    @staticmethod
+    def backward(ctx, grad):
+        grads, offset = [], 0
+        for shape in ctx.shapes:
+            grads.append(grad[offset:offset + shape.numel()].view(shape))
+            offset += shape.numel()
+        return (None, *grads)
+
+
+class FlatMaskStore(object):
+    """Keeps the gumbel_pi of every GumbelSigmoidMask in `model` in one contiguous buffer.
+
+    Each gumbel_pi stays a registered parameter (state_dict, optimizers and checkpoints are
+    unchanged) but its data becomes a view of the buffer. Hard samples of all layers are
+    then drawn with a single RNG call and one sigmoid/threshold pass over the buffer, and
+    the sparsity sum and active counts are single reductions.
+    Build it after the model has been moved to its device.
+    """
+    def __init__(self, model):
+        self.names, self.masks = [], []
+        for name, m in model.named_modules():
+            if isinstance(m, GumbelSigmoidMask):
+                self.names.append(f'{name}.gumbel_pi' if name else 'gumbel_pi')
+                self.masks.append(m)
+                m.store = self
+        self.position = {id(m): i for i, m in enumerate(self.masks)}
+        self._build()
+
+    def _build(self):
+        params = self.params()
+        self.flat = torch.cat([p.data.view(-1) for p in params])
+        self.lengths = [p.numel() for p in params]
+        offset = 0
+        for p, n in zip(params, self.lengths):
+            p.data = self.flat[offset:offset + n].view(p.shape)
+            offset += n
+        self.data_ptrs = [p.data_ptr() for p in params]
+        self.samples = None
+
+    def params(self):
+        return [m.gumbel_pi for m in self.masks]
+
+    def flat_pi(self):
+        """Differentiable flat view of all gumbel_pi"""
+        params = self.params()
+        if [p.data_ptr() for p in params] != self.data_ptrs:
+            self._build() # Parameters were moved or replaced
+        return _FlatView.apply(self.flat, *params)
+
+    def _resample(self, eps=1e-10):
+        logits = torch.sigmoid(self.flat_pi())
+        uniform = logits.new_empty([2, logits.numel()]).uniform_(0, 1)
+        noise = -((uniform[1] + eps).log() / (uniform[0] + eps).log() + eps).log()
+        res = torch.sigmoid(logits + noise)
+        res = ((res > 0.5).type_as(res) - res).detach() + res
+        self.samples = [s.view(m.gumbel_pi.shape)
+                        for s, m in zip(torch.split(res, self.lengths), self.masks)]
+        self.consumed = [False] * len(self.masks)
+
+    def sample(self, mask):
+        # All layers are sampled together, again as soon as a layer asks twice (next forward)
+        i = self.position[id(mask)]
+        if self.samples is None or self.consumed[i]:
+            self._resample()
+        self.consumed[i] = True
+        return self.samples[i]
+
+    def sparsity(self):
+        return self.flat_pi().sum()
 
+    def active_counts(self):
+        """Number of surviving weights of each layer"""
+        with torch.no_grad(): # flat_pi() first rebuilds the buffer if gumbel_pi were replaced
+            active = (self.flat_pi() >= 0).float()
+        return torch.segment_reduce(active, 'sum', lengths=torch.tensor(self.lengths, device=active.device))
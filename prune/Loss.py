@@ -8,17 +8,188 @@ import torch
 import torch.nn as nn
 
 
+class _ChunkedSupConLoss(torch.autograd.Function):
+    """DebiasedSupConLoss computed over blocks of `chunk_size` anchor rows.
+
+    Only [chunk_size, n_contrast] logits exist at a time. Backward recomputes each block
+    from the saved features and the per-row log-sum-exp. pair_masks(rows) returns boolean
+    (positive, excluded) pairs of anchor `rows`; excluded pairs (self-contrast) are left
+    out of both the positives and the denominator.
+    """
+    @staticmethod
+    def _logits(anchor, contrast, rows, excluded, temperature):
+        logits = torch.matmul(anchor[rows], contrast.T) / temperature
+        return logits.masked_fill_(excluded, float('-inf'))
+
+    @staticmethod
+    def forward(ctx, anchor, contrast, pair_masks, temperature, scale, chunk_size):
+        lse, pos_sum, pos_count = [], [], []
+        for start in range(0, anchor.shape[0], chunk_size):
+            rows = torch.arange(start, min(start + chunk_size, anchor.shape[0]), device=anchor.device)
+            mask, excluded = pair_masks(rows)
+            logits = _ChunkedSupConLoss._logits(anchor, contrast, rows, excluded, temperature)
+            lse.append(torch.logsumexp(logits, dim=1))
+            pos_sum.append(logits.masked_fill(~mask, 0).sum(1))
+            pos_count.append(mask.sum(1))
+        lse, pos_sum, pos_count = torch.cat(lse), torch.cat(pos_sum), torch.cat(pos_count)
+
+        # Mean over rows with positives, without boolean indexing (no host synchronization)
+        valid = pos_count != 0
+        mean_log_prob_pos = torch.where(valid, pos_sum / pos_count.clamp(min=1) - lse, torch.zeros_like(lse))
+        loss = - scale * mean_log_prob_pos.sum() / valid.sum()
+
+        ctx.save_for_backward(anchor, contrast, lse, pos_count)
+        ctx.pair_masks, ctx.temperature, ctx.scale, ctx.chunk_size = pair_masks, temperature, scale, chunk_size
+        ctx.num_valid = valid.sum()
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        anchor, contrast, lse, pos_count = ctx.saved_tensors
+        # d loss / d logit_ij = -scale / num_valid * (mask_ij / count_i - softmax_ij) on valid rows
+        coef = (pos_count != 0).to(anchor.dtype) * (- ctx.scale * grad_output / ctx.num_valid)
+        pos_count = pos_count.clamp(min=1).to(anchor.dtype)
+
+        grad_anchor = torch.zeros_like(anchor)
+        grad_contrast = torch.zeros_like(contrast)
+        for start in range(0, anchor.shape[0], ctx.chunk_size):
+            rows = torch.arange(start, min(start + ctx.chunk_size, anchor.shape[0]), device=anchor.device)
+            with torch.no_grad():
+                mask, excluded = ctx.pair_masks(rows)
+                logits = _ChunkedSupConLoss._logits(anchor, contrast, rows, excluded, ctx.temperature)
+                prob = torch.exp(logits - lse[rows, None])
+                grad_logits = (mask / pos_count[rows, None] - prob) * (coef[rows, None] / ctx.temperature)
+                grad_anchor[rows] = torch.matmul(grad_logits, contrast)
+                grad_contrast += torch.matmul(grad_logits.T, anchor[rows])
+        return grad_anchor, grad_contrast, None, None, None, None
+
+
+class FeatureMemoryBank(object):
+    """FIFO queue of recent (detached) features with their class label, pseudo bias label
+    and dataset index, used by DebiasedSupConLoss as extra contrast samples.
+    A sample enqueued again replaces its older entry. Storage is allocated on the first
+    enqueue; empty or dropped slots have index -1."""
+    def __init__(self, size):
+        self.size = size
+        self.features = None
+        self.ptr = 0
+
+    def enqueue(self, features, labels, biased_label, index):
+        features = features.detach()
+        if self.features is None:
+            device = features.device
+            self.features = features.new_zeros(self.size, features.shape[1])
+            self.labels = torch.zeros(self.size, dtype=torch.long, device=device)
+            self.biased_label = torch.zeros(self.size, device=device)
+            self.index = torch.full((self.size,), -1, dtype=torch.long, device=device)
+
+        index = index.to(self.index.device).long()
+        self.index.masked_fill_(torch.isin(self.index, index), -1) # Drop stale copies
+        # Only the last occurrence of an index repeated within the batch is kept
+        arange = torch.arange(len(index), device=index.device)
+        repeated = ((index[:, None] == index[None, :]) & (arange[:, None] < arange[None, :])).any(1)
+        index = index.masked_fill(repeated, -1)
+        n = min(features.shape[0], self.size)
+        slots = (self.ptr + torch.arange(n, device=self.index.device)) % self.size
+        self.features[slots] = features[-n:]
+        self.labels[slots] = labels[-n:].view(-1).long()
+        self.biased_label[slots] = biased_label[-n:].view(-1).float()
+        self.index[slots] = index[-n:]
+        self.ptr = (self.ptr + n) % self.size
+
+    def state_dict(self):
+        return dict(self.__dict__)
+
+    def load_state_dict(self, state):
+        self.__dict__.update(state)
+
+    def get(self):
+        # Returns the whole (features, labels, biased_label, index) buffers: selecting the
+        # filled entries would synchronize with the host, DebiasedSupConLoss excludes the others
+        if self.features is None:
+            return None
+        return self.features, self.labels, self.biased_label, self.index
+
+
 class DebiasedSupConLoss(nn.Module):
     """Supervised Contrastive Learning: https://arxiv.org/pdf/2004.11362.pdf.
-    It also supports the unsupervised contrastive loss in SimCLR"""
+    It also supports the unsupervised contrastive loss in SimCLR.
+    With `chunk_size`, the loss is computed blockwise without any [bsz, bsz] float
+    tensor (same value and gradients). With a FeatureMemoryBank, the anchors are also
+    contrasted against the queued features (blockwise as well)."""
     def __init__(self, temperature=0.07, contrast_mode='all',
-                 base_temperature=0.07):
+                 base_temperature=0.07, chunk_size=None):
         super(DebiasedSupConLoss, self).__init__()
         self.temperature = temperature
         self.contrast_mode = contrast_mode
         self.base_temperature = base_temperature
+        self.chunk_size = chunk_size
+
+    def _pair_masks_fn(self, batch_size, num_contrast, labels, biased_label, device,
+                       bank=None, index=None):
+        # Same pairs as the dense label_mask & bias_mask, tiled over views, without materializing it
+        if labels is None and biased_label is None:
+            labels = torch.arange(batch_size, device=device)
+        elif labels is None:
+            raise ValueError
+        labels = labels.contiguous().view(-1).to(device)
+        if labels.shape[0] != batch_size:
+            raise ValueError('Num of labels does not match num of features')
+        contrast_idx = torch.arange(num_contrast, device=device) % batch_size
+        contrast_labels = labels[contrast_idx]
+        if biased_label is not None:
+            # A 1-D biased_label broadcasts over anchors (bias of the contrast sample only),
+            # a [bsz, 1] one is OR-ed between anchor and contrast, as with logical_or(b, b.T)
+            row_bias = biased_label.dim() > 1
+            biased_label = biased_label.reshape(-1).to(device) != 0
+            contrast_bias = biased_label[contrast_idx]
+        if bank is not None:
+            _, bank_labels, bank_bias, bank_index = bank
+            contrast_labels = torch.cat([contrast_labels, bank_labels])
+            if biased_label is not None:
+                contrast_bias = torch.cat([contrast_bias, bank_bias != 0])
+            index = index.to(device).long()
+
+        def pair_masks(rows):
+            anchor_idx = rows % batch_size
+            mask = labels[anchor_idx, None] == contrast_labels[None, :]
+            if biased_label is not None:
+                bias = contrast_bias[None, :]
+                if row_bias:
+                    bias = bias | biased_label[anchor_idx, None]
+                mask &= bias
+            excluded = torch.zeros_like(mask)
+            excluded[torch.arange(len(rows), device=device), rows] = True
+            if bank is not None:
+                # So do empty slots and an older copy of the anchor itself in the bank
+                excluded[:, num_contrast:] = (index[anchor_idx, None] == bank_index[None, :]) | \
+                    (bank_index[None, :] < 0)
+            mask &= ~excluded
+            return mask, excluded
+        return pair_masks
+
+    def _chunked_forward(self, features, labels, biased_label, memory_bank=None, index=None):
+        batch_size = features.shape[0]
+        contrast_feature = torch.cat(torch.unbind(features, dim=1), dim=0)
+        if self.contrast_mode == 'one':
+            anchor_feature = features[:, 0]
+        elif self.contrast_mode == 'all':
+            anchor_feature = contrast_feature
+        else:
+            raise ValueError('Unknown mode: {}'.format(self.contrast_mode))
+
+        num_contrast = contrast_feature.shape[0]
+        bank = memory_bank.get() if memory_bank is not None else None
+        if bank is not None:
+            contrast_feature = torch.cat([contrast_feature, bank[0].to(contrast_feature.dtype)])
+
+        pair_masks = self._pair_masks_fn(batch_size, num_contrast, labels, biased_label,
+                                         features.device, bank, index)
+        return _ChunkedSupConLoss.apply(anchor_feature, contrast_feature, pair_masks,
+                                        self.temperature, self.temperature / self.base_temperature,
+                                        self.chunk_size or anchor_feature.shape[0])
 
-    def forward(self, features, labels=None, biased_label=None):
+    def forward(self, features, labels=None, biased_label=None, memory_bank=None, index=None):
         """Compute loss for model. If both `labels` and `mask` are None,
         it degenerates to SimCLR unsupervised loss:
         https://arxiv.org/pdf/2002.05709.pdf
@@ -27,6 +198,8 @@ class DebiasedSupConLoss(nn.Module):
             labels: ground truth of shape [bsz].
             mask: contrastive mask of shape [bsz, bsz], mask_{i,j}=1 if sample j
                 has the same class as sample i. Can be asymmetric.
+            memory_bank: FeatureMemoryBank of extra contrast features.
+            index: dataset index of shape [bsz], required with memory_bank.
         Returns:
             A loss scalar.
         """
@@ -39,6 +212,8 @@ class DebiasedSupConLoss(nn.Module):
                              'at least 3 dimensions are required')
         if len(features.shape) > 3:
             features = features.view(features.shape[0], features.shape[1], -1)
+        if self.chunk_size or memory_bank is not None:
+            return self._chunked_forward(features, labels, biased_label, memory_bank, index)
 
         batch_size = features.shape[0]
         if labels is None and biased_label is None:
@@ -88,20 +263,19 @@ class DebiasedSupConLoss(nn.Module):
         )
 
         mask = mask * logits_mask
-        valid_idx = mask.sum(1) != 0
-        mask = mask[valid_idx]
-        logits_mask = logits_mask[valid_idx]
+        pos_count = mask.sum(1)
 
         # compute log_prob
-        logits = logits[valid_idx]
         exp_logits = torch.exp(logits) * logits_mask
         log_prob = logits - torch.log(exp_logits.sum(1, keepdim=True))
 
-        # compute mean of log-likelihood over positive
-        mean_log_prob_pos = (mask * log_prob).sum(1) / mask.sum(1)
+        # compute mean of log-likelihood over positive, on rows with positives only,
+        # without boolean indexing (no host synchronization)
+        valid = pos_count != 0
+        mean_log_prob_pos = torch.where(valid, (mask * log_prob).sum(1) / pos_count.clamp(min=1),
+                                        torch.zeros_like(pos_count))
 
         # loss
-        loss = - (self.temperature / self.base_temperature) * mean_log_prob_pos
-        loss = loss.mean()
+        loss = - (self.temperature / self.base_temperature) * mean_log_prob_pos.sum() / valid.sum()
 
         return loss
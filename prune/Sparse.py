@@ -0,0 +1,111 @@
+"""Sparse-weight inference for unstructured DCWP masks.
+
+sparsify_model() first compacts a frozen Gate network (prune/Compact.py), then stores the
+weight of each remaining Conv2d/Linear as a CSR matrix when that layer is sparse enough
+and the sparse kernel is measured to be faster on the example batch. Convolutions run as
+CSR x im2col columns. Meant for CPU inference; the returned model is in eval mode.
+"""
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from prune.Compact import compact_model, replace_modules, CompactConv2d, CompactLinear
+
+
+class SparseLinear(nn.Module):
+    def __init__(self, linear):
+        super(SparseLinear, self).__init__()
+        self.in_features, self.out_features = linear.in_features, linear.out_features
+        self.register_buffer('weight', linear.weight.detach().to_sparse_csr())
+        self.register_buffer('bias', None if linear.bias is None else linear.bias.detach().clone())
+
+    def forward(self, input, pruning=False, freeze=False):
+        out = torch.sparse.mm(self.weight, input.t()).t()
+        if self.bias is not None:
+            out = out + self.bias
+        return out
+
+
+class SparseConv2d(nn.Module):
+    def __init__(self, conv):
+        super(SparseConv2d, self).__init__()
+        if conv.groups != 1 or conv.padding_mode != 'zeros':
+            raise ValueError('SparseConv2d supports groups=1 and zero padding only')
+        self.out_channels = conv.out_channels
+        self.kernel_size, self.stride = conv.kernel_size, conv.stride
+        self.padding, self.dilation = conv.padding, conv.dilation
+        self.register_buffer('weight', conv.weight.detach().flatten(1).to_sparse_csr())
+        self.register_buffer('bias', None if conv.bias is None else conv.bias.detach().clone())
+
+    def forward(self, input, pruning=False, freeze=False):
+        b, _, h, w = input.shape
+        h_out = (h + 2 * self.padding[0] - self.dilation[0] * (self.kernel_size[0] - 1) - 1) // self.stride[0] + 1
+        w_out = (w + 2 * self.padding[1] - self.dilation[1] * (self.kernel_size[1] - 1) - 1) // self.stride[1] + 1
+
+        cols = F.unfold(input, self.kernel_size, self.dilation, self.padding, self.stride) # [B, C*k*k, L]
+        cols = cols.transpose(0, 1).reshape(cols.size(1), -1) # [C*k*k, B*L]
+        out = torch.sparse.mm(self.weight, cols) # [out, B*L]
+        out = out.view(self.out_channels, b, h_out * w_out).transpose(0, 1)
+        if self.bias is not None:
+            out = out + self.bias.view(1, -1, 1)
+        return out.reshape(b, self.out_channels, h_out, w_out)
+
+
+def _latency(layer, input, repeats):
+    with torch.no_grad():
+        for _ in range(2):
+            layer(input)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            layer(input)
+    return (time.perf_counter() - start) / repeats
+
+
+def _layer_inputs(model, example_input):
+    inputs = {}
+
+    def hook(module, args):
+        inputs[module] = args[0].detach()
+
+    handles = [m.register_forward_pre_hook(hook) for m in model.modules()
+               if isinstance(m, (CompactConv2d, CompactLinear))]
+    with torch.no_grad():
+        model(example_input)
+    for h in handles:
+        h.remove()
+    return inputs
+
+
+def sparsify_model(model, example_input, max_density=0.5, benchmark=True, repeats=10):
+    """Return (sparse copy of a frozen Gate network, report).
+
+    A layer becomes sparse when its density (nonzero weight ratio) is at most
+    `max_density` and, with `benchmark`, the sparse kernel is faster than the dense one on
+    its input from `example_input`. report maps layer names to density, choice and the
+    measured latencies in seconds.
+    """
+    model = compact_model(model, example_input)
+    inputs = _layer_inputs(model, example_input)
+
+    report, replace = {}, {}
+    for name, layer in model.named_modules():
+        if layer not in inputs:
+            continue
+        density = (layer.weight != 0).float().mean().item()
+        entry = dict(density=density, sparse=False)
+        if density <= max_density and (isinstance(layer, nn.Linear) or layer.groups == 1):
+            sparse = SparseLinear(layer) if isinstance(layer, nn.Linear) else SparseConv2d(layer)
+            if benchmark:
+                entry['dense_latency'] = _latency(layer, inputs[layer], repeats)
+                entry['sparse_latency'] = _latency(sparse, inputs[layer], repeats)
+                entry['sparse'] = entry['sparse_latency'] < entry['dense_latency']
+            else:
+                entry['sparse'] = True
+            if entry['sparse']:
+                replace[layer] = sparse
+        report[name] = entry
+
+    replace_modules(model, replace)
+    return model, report
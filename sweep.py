@@ -0,0 +1,143 @@
+"""Hyperparameter sweeps that share pretraining, mining and pruning across runs.
+
+    python sweep.py --grid lambda_sparse=1e-8,1e-7 lambda_upweight=20,50 --num_procs 4 \\
+        --mode prune --data cmnist --pseudo_label_method wrong
+
+Options other than the sweep's own ones are main.py options, shared by every run; --grid
+values override them. Every run is a phase chain pretrain -> mine -> prune -> retrain.
+A phase artifact is keyed by the options that can change it, so runs differing only in
+later-phase options (e.g. lambda_sparse) share their pretraining and mining. Distinct
+artifacts of a phase are trained in parallel (main.py --stop_after) in their own
+experiment folders; the checkpoints are then linked into the folders of the dependent
+phases, where PruneSolver.train finds and skips them.
+"""
+import os
+import copy
+import json
+import hashlib
+import argparse
+import itertools
+import multiprocessing
+from os.path import join as ospj
+
+from main import get_parser, check_args, main
+from util import setup, modify_args_for_baselines
+
+PHASES = ['pretrain', 'mine', 'prune', 'retrain']
+
+# Options first read in a phase other than pretraining. Any other option is assumed to
+# change pretraining, unless it is in IGNORED.
+PHASE_ARGS = {
+    'mine': ['earlystop_iter', 'supervised', 'tau', 'mine_topk'],
+    'prune': ['lambda_con_prune', 'lambda_sparse', 'lr_prune', 'pruning_iter', 'uniform_weight',
+              'con_chunk_size', 'memory_bank_size', 'fused_mask', 'activation_cache'],
+    'retrain': ['lambda_con_retrain', 'lambda_upweight', 'lr_main', 'retrain_iter', 'lr_decay_step_main',
+                'lr_gamma_main', 'reinitialize', 'mask_in_place', 'save_every_retrain',
+                'export_pruned', 'export_dtype'],
+}
+# Options that never change a checkpoint
+IGNORED = ['phase', 'stop_after', 'exp_name', 'log_dir', 'result_dir', 'checkpoint_dir',
+           'print_every', 'eval_every', 'eval_every_retrain', 'num_workers', 'num_prefetch',
+           'async_checkpoint', 'max_pending_ckpt', 'keep_last_ckpt', 'save_state_every',
+           'compact', 'sparse_inference', 'sparse_max_density',
+           'total_iter', 'swap_iter', 'beta1', 'beta2', 'lambda_swap', 'lambda_dis_align', 'lambda_swap_align']
+
+
+def phase_key(args, phase):
+    """Hash of the options that affect the artifacts of `phase` and of its dependencies"""
+    later = [name for p in PHASES[PHASES.index(phase)+1:] for name in PHASE_ARGS.get(p, [])]
+    options = {k: v for k, v in sorted(vars(args).items()) if k not in IGNORED and k not in later}
+    return hashlib.sha1(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()[:10]
+
+
+def parse_grid(grid):
+    # ['lambda_sparse=1e-8,1e-7', ...] -> [[('lambda_sparse', '1e-8'), ('lambda_sparse', '1e-7')], ...]
+    axes = []
+    for item in grid:
+        name, values = item.split('=', 1)
+        axes.append([(name, value) for value in values.split(',')])
+    return axes
+
+
+def grid_argv(parser, point):
+    argv = []
+    for name, value in point:
+        action = next(a for a in parser._actions if a.dest == name)
+        if action.nargs == 0: # store_true options take true/false
+            if value.lower() in ['true', '1']:
+                argv.append(f'--{name}')
+        else:
+            argv += [f'--{name}', value]
+    return argv
+
+
+def _run(args):
+    main(args)
+
+
+def link_artifacts(src_args, dst_args):
+    """Symlink the checkpoints of a finished phase into the folder of the next one"""
+    src = setup(copy.copy(src_args)).checkpoint_dir
+    dst = setup(copy.copy(dst_args)).checkpoint_dir
+    for fname in os.listdir(src):
+        target = ospj(dst, fname)
+        if not os.path.lexists(target):
+            os.symlink(os.path.realpath(ospj(src, fname)), target)
+
+
+def sweep(base_argv, grid, num_procs):
+    parser = get_parser()
+    runs = []
+    for point in itertools.product(*parse_grid(grid)):
+        args = parser.parse_args(base_argv + grid_argv(parser, point))
+        check_args(parser, args)
+        args = modify_args_for_baselines(args)
+        if args.seeds and len(args.seeds) > 1:
+            raise ValueError('Sweep over --seed instead of --seeds')
+        if args.phase != 'train':
+            raise ValueError('Sweeps run the train phase')
+        name = '_'.join(f'{n}={v}' for n, v in point)
+        args.exp_name = f'{args.exp_name}_{name}' if args.exp_name else name
+        runs.append(args)
+
+    # Distinct artifacts of each phase. Intermediate ones get their own experiment folders
+    nodes = [] # [{key: args}] for every phase
+    for phase in PHASES:
+        level = {}
+        for args in runs:
+            key = phase_key(args, phase)
+            if key not in level:
+                job = copy.copy(args)
+                if phase != 'retrain':
+                    job.exp_name = f'sweep_{phase}_{key}'
+                    job.stop_after = phase
+                level[key] = job
+        nodes.append(level)
+        print(f'{phase}: {len(level)} distinct job(s) for {len(runs)} run(s)')
+
+    context = multiprocessing.get_context('spawn')
+    for i, (phase, level) in enumerate(zip(PHASES, nodes)):
+        if i > 0:
+            for key, job in level.items():
+                parent = nodes[i-1][phase_key(job, PHASES[i-1])]
+                link_artifacts(parent, job)
+        print(f'=== Sweep: {phase} ({len(level)} job(s)) ===')
+        # One job per worker process, so that logging is set up for each experiment
+        with context.Pool(min(num_procs, len(level)), maxtasksperchild=1) as pool:
+            pool.map(_run, list(level.values()), chunksize=1)
+
+    summary = {args.exp_name: vars(setup(copy.copy(args))) for args in nodes[-1].values()}
+    fname = ospj(runs[0].log_dir, 'sweep.json')
+    with open(fname, 'w') as f:
+        json.dump(summary, f, indent=2)
+    print('Saved the sweep summary in', fname)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a grid of main.py trainings sharing common phases')
+    parser.add_argument('--grid', type=str, nargs='+', required=True,
+                        help='Swept options as name=value1,value2,... (main.py option names)')
+    parser.add_argument('--num_procs', type=int, default=1,
+                        help='Number of trainings run in parallel')
+    sweep_args, base_argv = parser.parse_known_args()
+    sweep(base_argv, sweep_args.grid, sweep_args.num_procs)
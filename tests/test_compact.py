@@ -0,0 +1,58 @@
+import unittest
+
+import torch
+import torch.nn as nn
+
+from prune.Compact import compact_model, count_parameters
+from prune.GateLayer import GateMixin
+from prune.GateSimpleModel import GateCNN, GateFCN
+from prune.GateResnet import GateResNet18
+from prune.GateWideResnet import wrn
+
+
+def _random_masks(model, generator):
+    # Random masks that also prune whole output and input channels, random BatchNorm statistics
+    with torch.no_grad():
+        for m in model.modules():
+            if isinstance(m, GateMixin):
+                pi = m.mask.gumbel_pi
+                pi.copy_(torch.randn(pi.shape, generator=generator) + 1)
+                pi[torch.rand(pi.shape[0], generator=generator) < 0.3] = -1
+                pi[:, torch.rand(pi.shape[1], generator=generator) < 0.3] = -1
+            elif isinstance(m, nn.BatchNorm2d):
+                m.running_mean.copy_(torch.randn(m.num_features, generator=generator))
+                m.running_var.copy_(torch.rand(m.num_features, generator=generator) + 0.5)
+                m.weight.copy_(torch.randn(m.num_features, generator=generator))
+                m.bias.copy_(torch.randn(m.num_features, generator=generator))
+
+
+class CompactModelTest(unittest.TestCase):
+    def _check(self, model, input_shape):
+        generator = torch.Generator().manual_seed(0)
+        model = model.double()
+        _random_masks(model, generator)
+        model.eval()
+        model.pruning_switch(False)
+        model.freeze_switch(True)
+        x = torch.rand(4, *input_shape, generator=generator, dtype=torch.double)
+
+        compact = compact_model(model, x)
+        self.assertLess(count_parameters(compact), count_parameters(model))
+        with torch.no_grad():
+            torch.testing.assert_close(compact(x), model(x))
+
+    def test_gate_cnn(self):
+        self._check(GateCNN(), (3, 28, 28))
+
+    def test_gate_fcn(self):
+        self._check(GateFCN(), (3, 28, 28))
+
+    def test_resnet(self):
+        self._check(GateResNet18(), (3, 32, 32))
+
+    def test_wide_resnet(self):
+        self._check(wrn(10, 10, widen_factor=2), (3, 32, 32))
+
+
+if __name__ == '__main__':
+    unittest.main()
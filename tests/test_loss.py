@@ -0,0 +1,54 @@
+import unittest
+
+import torch
+import torch.nn.functional as F
+
+from prune.Loss import DebiasedSupConLoss, FeatureMemoryBank
+
+
+def _inputs(batch_size=12, n_views=2, dim=8, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    features = F.normalize(torch.randn(batch_size, n_views, dim, generator=generator, dtype=torch.double), dim=2)
+    labels = torch.randint(3, (batch_size,), generator=generator)
+    biased_label = torch.randint(2, (batch_size,), generator=generator)
+    return features, labels, biased_label
+
+
+class ChunkedSupConLossTest(unittest.TestCase):
+    def _loss_and_grad(self, criterion, features, *args, **kwargs):
+        features = features.clone().requires_grad_()
+        loss = criterion(features, *args, **kwargs)
+        loss.backward()
+        return loss.detach(), features.grad
+
+    def test_matches_dense(self):
+        features, labels, biased_label = _inputs()
+        for contrast_mode in ['all', 'one']:
+            for bias in [None, biased_label, biased_label.view(-1, 1)]:
+                dense = DebiasedSupConLoss(contrast_mode=contrast_mode)
+                chunked = DebiasedSupConLoss(contrast_mode=contrast_mode, chunk_size=5)
+                loss, grad = self._loss_and_grad(dense, features, labels, bias)
+                chunked_loss, chunked_grad = self._loss_and_grad(chunked, features, labels, bias)
+                torch.testing.assert_close(chunked_loss, loss)
+                torch.testing.assert_close(chunked_grad, grad)
+
+    def test_gradcheck(self):
+        features, labels, biased_label = _inputs(batch_size=6, dim=4)
+        criterion = DebiasedSupConLoss(chunk_size=4)
+        features.requires_grad_()
+        self.assertTrue(torch.autograd.gradcheck(lambda f: criterion(f, labels, biased_label), (features,)))
+
+    def test_empty_bank_slots_are_excluded(self):
+        features, labels, biased_label = _inputs(batch_size=8, n_views=1)
+        queued, queued_labels, queued_bias = _inputs(batch_size=3, n_views=1, seed=1)
+        criterion = DebiasedSupConLoss(chunk_size=5)
+        losses = []
+        for size in [3, 16]: # Full bank, bank with 13 empty slots
+            bank = FeatureMemoryBank(size)
+            bank.enqueue(queued[:, 0], queued_labels, queued_bias, torch.arange(100, 103))
+            losses.append(criterion(features, labels, biased_label, memory_bank=bank, index=torch.arange(8)))
+        torch.testing.assert_close(losses[1], losses[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
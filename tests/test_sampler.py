@@ -0,0 +1,66 @@
+import itertools
+import unittest
+
+import torch
+
+from data.sampler import (EpochRandomSampler, InfiniteWeightedSampler, DistributedWeightedSampler,
+                          EpochDistributedSampler)
+
+
+def _epoch_batches(sampler, batch_size, num_epochs):
+    # Batches of a DataLoader without drop_last over `num_epochs` iterations of `sampler`
+    batches = []
+    for _ in range(num_epochs):
+        indices = list(sampler)
+        batches += [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+    return batches
+
+
+class ResumeTest(unittest.TestCase):
+    batch_size = 4
+
+    def _check_epoch_sampler(self, make_sampler):
+        uninterrupted = _epoch_batches(make_sampler(), self.batch_size, 10)
+        for num_batches in [0, 3, 7, 8, 13]:
+            sampler = make_sampler()
+            sampler.resume(num_batches, self.batch_size)
+            resumed = _epoch_batches(sampler, self.batch_size, 4)
+            self.assertEqual(resumed[:8], uninterrupted[num_batches:num_batches + 8])
+
+    def _check_infinite_sampler(self, make_sampler, step_size):
+        uninterrupted = list(itertools.islice(make_sampler(), 20 * step_size))
+        for num_batches in [0, 3, 11]:
+            sampler = make_sampler()
+            sampler.resume(num_batches, self.batch_size)
+            resumed = list(itertools.islice(sampler, 5 * step_size))
+            self.assertEqual(resumed, uninterrupted[num_batches * step_size:(num_batches + 5) * step_size])
+
+    def test_epoch_random_sampler(self):
+        self._check_epoch_sampler(lambda: EpochRandomSampler(18, seed=1, salt='train'))
+
+    def test_distributed_weighted_sampler(self):
+        weights = torch.arange(1., 19.)
+        for rank in range(2):
+            self._check_epoch_sampler(lambda: DistributedWeightedSampler(weights, 30, rank=rank, num_shards=2,
+                                                                         seed=1, salt='prune'))
+
+    def test_epoch_distributed_sampler(self):
+        for rank in range(3):
+            self._check_epoch_sampler(lambda: EpochDistributedSampler(range(25), num_replicas=3, rank=rank,
+                                                                      seed=1, salt='train'))
+
+    def test_infinite_weighted_sampler(self):
+        weights = torch.arange(1., 19.)
+        self._check_infinite_sampler(lambda: InfiniteWeightedSampler(weights, self.batch_size, seed=1),
+                                     self.batch_size)
+        for rank in range(2):
+            self._check_infinite_sampler(lambda: InfiniteWeightedSampler(weights, self.batch_size, seed=1,
+                                                                         rank=rank, num_shards=2),
+                                         self.batch_size // 2)
+        replica_weights = torch.stack([weights, weights.flip(0)]) # One batch per replica at every step
+        self._check_infinite_sampler(lambda: InfiniteWeightedSampler(replica_weights, self.batch_size, seed=1),
+                                     2 * self.batch_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
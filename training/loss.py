@@ -4,24 +4,38 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-import numpy as np
-
 
 class GeneralizedCELoss(nn.Module):
 
-    def __init__(self, q=0.7):
+    def __init__(self, q=0.7, nan_check_every=1):
         super(GeneralizedCELoss, self).__init__()
         self.q = q
+        # NaN flags are accumulated on device and read back every `nan_check_every` calls
+        self.nan_check_every = nan_check_every
+        self.num_calls = 0
+        self.nan_p = None
+        self.nan_Yg = None
+
+    def _check_nan(self, p, Yg):
+        nan_p, nan_Yg = torch.isnan(p.mean().detach()), torch.isnan(Yg.mean().detach())
+        self.nan_p = nan_p if self.nan_p is None else self.nan_p | nan_p
+        self.nan_Yg = nan_Yg if self.nan_Yg is None else self.nan_Yg | nan_Yg
+        self.num_calls += 1
+        if self.num_calls % self.nan_check_every == 0:
+            nan_p, nan_Yg = torch.stack([self.nan_p, self.nan_Yg]).tolist()
+            self.nan_p, self.nan_Yg = None, None
+            if nan_p:
+                raise NameError('GCE_p')
+            if nan_Yg:
+                raise NameError('GCE_Yg')
 
     def forward(self, logits, targets):
+        logits = logits.float() # fp32 under autocast: Yg**q of small probabilities
         p = F.softmax(logits, dim=1)
-        if np.isnan(p.mean().item()):
-            raise NameError('GCE_p')
         Yg = torch.gather(p, 1, torch.unsqueeze(targets, 1))
         # modify gradient of cross entropy
         loss_weight = (Yg.squeeze().detach()**self.q)*self.q
-        if np.isnan(Yg.mean().item()):
-            raise NameError('GCE_Yg')
+        self._check_nan(p, Yg)
 
         loss = F.cross_entropy(logits, targets, reduction='none') * loss_weight
         return loss
@@ -0,0 +1,106 @@
+"""Pseudo bias labels mined from cached per-sample scores of the pretrained networks.
+
+Next to the pretrain checkpoint of a step, `{step:06d}_scores.npz` holds columns over the
+train split in dataset order: attr [N, 2], float16 logits [N, C] of the classifier
+('main_logits') and of the biased classifier ('bias_logits'), and for
+--pseudo_label_method ensemble the score accumulated while pretraining ('ensemble', at
+the last step). Logits are computed by the first mining at a step; afterwards any rule,
+tau or top-k is a vectorized pass over the table. To compare rules without training:
+
+    python -m training.mining expr/checkpoints/<exp>/000040_scores.npz --tau 0.5 0.8 --topk 500
+"""
+import os
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from munch import Munch
+
+from util.storage import atomic_save
+
+
+def score_path(checkpoint_dir, step):
+    # Next to the pretrain checkpoint itself: sweep.py links it into the folders of later
+    # phases, which then all share the table of the pretraining run
+    ckpt = os.path.realpath(os.path.join(checkpoint_dir, '{:06d}_pretrain_nets.ckpt'.format(step)))
+    return os.path.join(os.path.dirname(ckpt), '{:06d}_scores.npz'.format(step))
+
+
+def load_scores(fname):
+    if not os.path.exists(fname):
+        return Munch()
+    with np.load(fname) as f:
+        return Munch({k: torch.from_numpy(f[k]) for k in f.files})
+
+
+def save_scores(fname, **columns):
+    # Adds (or replaces) columns of the table in fname
+    table = {k: v.numpy() for k, v in load_scores(fname).items()}
+    for k, v in columns.items():
+        v = v.detach().cpu()
+        table[k] = (v.half() if k.endswith('logits') else v).numpy()
+    atomic_save(fname, lambda tmp: np.savez(tmp, **table))
+
+
+def bias_score(logits, label):
+    # 1 - p(label): the per-sample score of the ensemble rule (its GCE loss is monotone in it)
+    prob = F.softmax(logits.float(), dim=1)
+    return 1 - prob.gather(1, label.long().unsqueeze(1)).squeeze(1)
+
+
+def debias_label(attr, data):
+    label, bias_label = attr[:, 0], attr[:, 1]
+    if data != 'celebA':
+        return (label != bias_label).float()
+    return (label == bias_label).float()
+
+
+def mine(scores, method, which='main', tau=0.8, topk=None):
+    """Pseudo bias labels [N] from a score table.
+    'wrong': samples misclassified by the `which` ('main' or 'bias') logits.
+    'ensemble': samples whose ensemble score exceeds tau.
+    With topk, the topk samples of highest score (1 - p(label) of `which` for 'wrong')."""
+    label = scores.attr[:, 0]
+    if method == 'ensemble':
+        score = scores.ensemble.float()
+        pseudo_label = (score > tau).long()
+    else:
+        logits = scores[f'{which}_logits'].float()
+        score = bias_score(logits, label)
+        pseudo_label = (logits.argmax(1) != label).float()
+    if topk is not None:
+        selected = score.topk(min(topk, len(score))).indices
+        pseudo_label = torch.zeros_like(pseudo_label).index_fill_(0, selected, 1)
+    return pseudo_label
+
+
+def precision_recall(pseudo_label, debias_label):
+    hit = torch.sum((pseudo_label == 1) & (debias_label == 1))
+    return hit / torch.sum(pseudo_label), hit / torch.sum(debias_label)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precision and recall of mining rules on a score table')
+    parser.add_argument('scores', type=str)
+    parser.add_argument('--data', type=str, default='cmnist')
+    parser.add_argument('--tau', type=float, nargs='*', default=[])
+    parser.add_argument('--topk', type=int, nargs='*', default=[])
+    args = parser.parse_args()
+
+    scores = load_scores(args.scores)
+    target = debias_label(scores.attr, args.data)
+    rules = []
+    for which in ['main', 'bias']:
+        if f'{which}_logits' in scores:
+            rules += [(f'wrong/{which}', dict(method='wrong', which=which))]
+            rules += [(f'wrong/{which} top-{k}', dict(method='wrong', which=which, topk=k)) for k in args.topk]
+    if 'ensemble' in scores:
+        rules += [(f'ensemble tau={tau}', dict(method='ensemble', tau=tau)) for tau in args.tau]
+        rules += [(f'ensemble top-{k}', dict(method='ensemble', topk=k)) for k in args.topk]
+
+    print('%-24s %8s %10s %8s' % ('rule', 'mined', 'precision', 'recall'))
+    for name, rule in rules:
+        pseudo_label = mine(scores, **rule)
+        precision, recall = precision_recall(pseudo_label, target)
+        print('%-24s %8d %10.4f %8.4f' % (name, pseudo_label.sum().item(), precision, recall))
@@ -1,4 +1,5 @@
 import os
+import copy
 from os.path import join as ospj
 import time
 import datetime
@@ -12,11 +13,18 @@ import torch.nn.functional as F
 import torch.nn as nn
 
 import util.utils as utils
-from data.data_loader import InputFetcher
+from util.checkpoint import export_pruned, load_pruned
+from util import distributed
 from data.data_loader import get_original_loader, get_val_loader
+from data.activation_cache import build_activation_cache
+from training.mining import score_path, load_scores, save_scores, mine, debias_label
 from model.build_models import build_model
 from training.solver import Solver
-from prune.Loss import DebiasedSupConLoss
+from prune.Loss import DebiasedSupConLoss, FeatureMemoryBank
+from prune.GumbelSigmoid import FlatMaskStore
+from prune.Compact import compact_model, count_parameters
+from prune.Sparse import sparsify_model
+from prune.GateResnet import LowPassResNet
 
 
 class PruneSolver(Solver):
@@ -56,65 +64,78 @@ class PruneSolver(Solver):
                 self.scheduler_main[net] = torch.optim.lr_scheduler.StepLR(
                     self.optims_main[net], step_size=args.lr_decay_step_main, gamma=args.lr_gamma_main)
 
-        self.con_criterion = DebiasedSupConLoss()
+        self.con_criterion = DebiasedSupConLoss(chunk_size=args.con_chunk_size or None)
+
+        # All masks of the classifier share one buffer, sampled with a single kernel chain
+        self.mask_store = FlatMaskStore(self.nets.classifier) if args.fused_mask else None
+
+    def _stateful(self):
+        stateful = super(PruneSolver, self)._stateful()
+        stateful.update(optims_main=self.optims_main, optims_mask=self.optims_mask,
+                        scheduler_main=self.scheduler_main)
+        return stateful
 
     def sparsity_regularizer(self, token='gumbel_pi'):
+        if self.mask_store is not None:
+            return self.mask_store.sparsity()
         reg = 0.
         for n, p in self.nets.classifier.named_parameters():
             if token in n:
                 reg = reg + p.sum()
         return reg
 
+    def active_ratio(self):
+        # Returns (total active ratio, {param name: active ratio}) of the classifier masks
+        if self.mask_store is not None:
+            actives = self.mask_store.active_counts() # May rebuild the store first
+            names, totals = self.mask_store.names, self.mask_store.lengths
+        else:
+            params = [(n, p) for n, p in self.nets.classifier.named_parameters() if 'gumbel_pi' in n]
+            names, totals = [n for n, _ in params], [p.numel() for _, p in params]
+            actives = torch.stack([(p >= 0).sum() for _, p in params])
+        actives = actives.tolist() # Single host transfer
+        layerwise = {}
+        for n, active_n, total_n in zip(names, actives, totals):
+            layerwise[n] = active_n / total_n
+            if active_n == 0: print('Warning: Dead layer')
+        return sum(actives) / sum(totals), layerwise
+
+    def contrastive_loss(self, feature, label, bias_label, idx, memory_bank=None):
+        with torch.autocast(self.device.type, enabled=False): # Similarity logits in fp32
+            feature = F.normalize(feature.float(), dim=1)
+            loss_con = self.con_criterion(feature.unsqueeze(1), label, bias_label,
+                                          memory_bank=memory_bank, index=idx)
+        if memory_bank is not None:
+            memory_bank.enqueue(feature, label, bias_label, idx)
+        return loss_con
+
     def save_wrong_idx(self, loader):
-        self.nets.classifier.eval()
-        self.nets.biased_classifier.eval()
-
-        iterator = enumerate(loader)
-        total_wrong, total_num = 0, 0
-        wrong_idx = torch.empty(0).to(self.device)
-        debias_idx = torch.empty(0).to(self.device)
-        fname_full = []
-
-        for _, (idx, data, attr, fname) in iterator:
-            idx = idx.to(self.device)
-            label = attr[:, 0].to(self.device)
-            bias_label = attr[:, 1].to(self.device)
-            data = data.to(self.device)
-
-            with torch.no_grad():
-                if self.args.select_with_GCE or self.args.data == 'celebA':
-                    logit = self.nets.biased_classifier(data)
-                else:
-                    logit = self.nets.classifier(data)
-
-                pred = logit.data.max(1, keepdim=True)[1].squeeze(1)
-                wrong = (pred != label).long()
-
-                if self.args.data != 'celebA':
-                    debiased = (label != bias_label).long()
-                else:
-                    debiased = (label == bias_label).long()
-
-                total_wrong += wrong.sum()
-                total_num += wrong.shape[0]
-                wrong_idx = torch.cat((wrong_idx, idx[wrong == 1])).long()
-                debias_idx = torch.cat((debias_idx, idx[debiased == 1])).long()
-
-            fname_full = fname_full + fname
-
-        assert total_wrong == len(wrong_idx)
-        print('Number of wrong samples: ', total_wrong)
-        self.confirm_pseudo_label(wrong_idx, debias_idx, total_num)
-
-    def confirm_pseudo_label(self, wrong_idx, debias_idx, total_num):
-        wrong_label = torch.zeros(total_num).to(self.device)
-        debias_label = torch.zeros(total_num).to(self.device)
-
-        for idx in wrong_idx:
-            wrong_label[idx] = 1
-        for idx in debias_idx:
-            debias_label[idx] = 1
+        """Mine wrong_index.pth from the score table of the mining step. Only computes the
+        logits (one pass over `loader`) if the table does not hold them yet."""
+        args = self.args
+        which = 'bias' if args.select_with_GCE or args.data == 'celebA' else 'main'
+        if args.pseudo_label_method == 'wrong' or args.mode == 'JTT':
+            method, step = 'wrong', args.earlystop_iter or args.pretrain_iter
+        else:
+            method, step = 'ensemble', args.pretrain_iter
+        fname = score_path(args.checkpoint_dir, step)
+        scores = load_scores(fname)
+
+        if method == 'wrong' and f'{which}_logits' not in scores:
+            self._load_checkpoint(step, 'pretrain')
+            results = self.evaluate_models(loader, ['main', 'bias'], return_logits=True)
+            save_scores(fname, attr=results.attr, main_logits=results.main.logits,
+                        bias_logits=results.bias.logits)
+            self._load_checkpoint(args.pretrain_iter, 'pretrain')
+            scores = load_scores(fname)
+        elif method == 'ensemble' and 'ensemble' not in scores:
+            raise ValueError(f'No upweight ckpt and no ensemble scores in {fname}')
 
+        wrong_label = mine(scores, method, which, tau=args.tau, topk=args.mine_topk).to(self.device)
+        print('Number of wrong samples: ', wrong_label.sum())
+        self.confirm_pseudo_label(wrong_label, debias_label(scores.attr, args.data).to(self.device))
+
+    def confirm_pseudo_label(self, wrong_label, debias_label, checkpoint_dir=None):
         spur_precision = torch.sum(
                 (wrong_label == 1) & (debias_label == 1)
             ) / torch.sum(wrong_label)
@@ -124,7 +145,7 @@ class PruneSolver(Solver):
             ) / torch.sum(debias_label)
         print("Spurious recall", spur_recall)
 
-        wrong_idx_path = ospj(self.args.checkpoint_dir, 'wrong_index.pth')
+        wrong_idx_path = ospj(checkpoint_dir or self.args.checkpoint_dir, 'wrong_index.pth')
 
         if not self.args.supervised:
             torch.save(wrong_label, wrong_idx_path)
@@ -134,13 +155,55 @@ class PruneSolver(Solver):
         self.nets.classifier.train()
         self.nets.biased_classifier.train()
 
+    def _prefix_cache(self):
+        """Outputs of the never pruned prefix of a LowPassResNet on the train split. Only
+        gumbel_pi is learned while pruning, so the prefix is a fixed function of the sample:
+        it runs once in eval mode, and its BatchNorm layers keep the running statistics of
+        the pretrained model instead of using (and updating) batch statistics."""
+        args = self.args
+        if not isinstance(self.nets.classifier, LowPassResNet):
+            raise ValueError('--activation_cache needs a LowPassResNet classifier (--low_pass)')
+        fname = None
+        if args.activation_cache == 'memmap':
+            fname = ospj(args.checkpoint_dir, f'{args.pretrain_iter:06d}_prefix_cache.npy')
+        return build_activation_cache(args, self.nets.classifier, self.device, fname=fname)
+
+    def _load_wrong_label(self):
+        return torch.load(ospj(self.args.checkpoint_dir, 'wrong_index.pth'))
+
+    def _memory_bank(self):
+        return FeatureMemoryBank(self.args.memory_bank_size) if self.args.memory_bank_size > 0 else None
+
+    def _upweighted_losses(self, inputs, wrong_label, memory_bank):
+        # (classification loss, contrastive loss) of a pruning or retraining step
+        idx, x, label = inputs.index, inputs.x, inputs.y
+        bias_label = torch.index_select(wrong_label, 0, idx.long())
+        pred, feature = self.train_nets.classifier(x, feature=True)
+        loss_main = self.criterion(pred, label).mean()
+        loss_con = self.contrastive_loss(feature, label, bias_label, idx, memory_bank)
+        return loss_main, loss_con
+
+    def _log_active_ratio(self):
+        ratio, layerwise = self.active_ratio()
+        print('ratio:', ratio)
+        self.valid_logger.append(ratio, which='ratio')
+        self.valid_logger.append(layerwise, which='layerwise_ratio')
+
+    def _validate_classifier(self, loader, step, which, log=False):
+        # With log, the accuracies are also appended to the validation log under `which`
+        total_acc, valid_attrwise_acc = self.validation(loader)
+        self.report_validation(valid_attrwise_acc, total_acc, step, which=which)
+        if log:
+            self.valid_logger.append(total_acc.item(), which=which)
+            self.valid_logger.append(valid_attrwise_acc, which='groupwise_acc')
+
     def train_PRUNE(self, iters):
         args = self.args
         nets = self.nets
         optims = self.optims_mask # Train only pruning parameter
 
         # Load and balance data
-        wrong_label = torch.load(ospj(self.args.checkpoint_dir, 'wrong_index.pth'))
+        wrong_label = self._load_wrong_label()
         """
         remain = 1. - wrong_label
         subsampled_idx = remain.multinomial(min(int(wrong_label.sum() / self.attr_dims[1]), 1)).long()
@@ -152,127 +215,131 @@ class PruneSolver(Solver):
         upweight[wrong_label == 1] = 80
 
         sampling_weight = upweight if not args.uniform_weight else torch.ones_like(wrong_label)
-        balanced_loader = get_original_loader(args, sampling_weight=sampling_weight)
+        cache = self._prefix_cache() if args.activation_cache else None
+        balanced_loader = get_original_loader(args, sampling_weight=sampling_weight, dataset=cache,
+                                              salt='prune')
+
+        memory_bank = self._memory_bank()
+        metrics = utils.MetricBuffer(runs=self.num_replicas)
+        state = self._load_state('prune', metrics=metrics, memory_bank=memory_bank)
 
-        fetcher = InputFetcher(balanced_loader)
+        fetcher = self._get_fetcher(balanced_loader, start=state.consumed)
         fetcher_val = self.loaders.val
         start_time = time.time()
 
         self.nets.classifier.pruning_switch(True)
+        if cache is not None:
+            self.nets.classifier.cached_prefix_switch(True)
 
-        for i in range(iters):
+        for i in range(state.step, iters):
             inputs = next(fetcher)
-            idx, x, label, fname = inputs.index, inputs.x, inputs.y, inputs.fname
-            bias_label = torch.index_select(wrong_label, 0, idx.long())
-
-            pred, feature = self.nets.classifier(x, feature=True)
-            loss_main = self.criterion(pred, label).mean()
-            loss_reg = self.sparsity_regularizer()
-            loss_con = self.con_criterion(F.normalize(feature, dim=1).unsqueeze(1), label, bias_label)
-            loss = loss_main + args.lambda_sparse * loss_reg + args.lambda_con_prune * loss_con
+            with self.autocast():
+                loss_main, loss_con = self._upweighted_losses(inputs, wrong_label, memory_bank)
+                loss_reg = self.sparsity_regularizer()
+                loss = loss_main + args.lambda_sparse * loss_reg + args.lambda_con_prune * loss_con
 
             self._reset_grad()
             loss.backward()
             optims.classifier.step()
+            metrics.add(loss_main=loss_main, loss_reg=loss_reg, loss_con=loss_con)
 
             # print out log info
             if (i+1) % args.print_every == 0:
                 elapsed = time.time() - start_time
                 elapsed = str(datetime.timedelta(seconds=elapsed))[:-7]
+                losses = metrics.flush() # Means since the last print
                 log = "Elapsed time [%s], Iteration [%i/%i], LR [%.4f], "\
                     "Loss_main [%.6f] Loss_reg [%.6f] Loss_con [%.6f]" % (elapsed, i+1, iters,
                                                                           optims.classifier.param_groups[-1]['lr'],
-                                                                          loss_main.item(),
-                                                                          loss_reg.item(),
-                                                                          loss_con.item())
+                                                                          losses['loss_main'],
+                                                                          losses['loss_reg'],
+                                                                          losses['loss_con'])
                 print(log)
 
-            if (i+1) % args.eval_every == 0:
-                total = 0
-                active = 0
-                layerwise = {}
-                for n, p in self.nets.classifier.named_parameters():
-                    if 'gumbel_pi' in n:
-                        active_n = (p>=0).sum().item()
-                        total_n = torch.ones_like(p).sum().detach().item()
-                        layerwise[n] = active_n / total_n
-
-                        total += total_n
-                        active += active_n
-                        if active_n == 0: print('Warning: Dead layer')
-
-                ratio = active / total
-                print('ratio:', ratio)
-                self.valid_logger.append(ratio, which='ratio')
-                self.valid_logger.append(layerwise, which='layerwise_ratio')
+            if (i+1) % args.eval_every == 0 and distributed.is_main_process():
+                self._log_active_ratio()
 
                 self.nets.classifier.pruning_switch(False)
                 self.nets.classifier.freeze_switch(True)
-                total_acc, valid_attrwise_acc = self.validation(fetcher_val)
-                self.report_validation(valid_attrwise_acc, total_acc, i, which='prune')
+                if cache is not None:
+                    self.nets.classifier.cached_prefix_switch(False) # Validation images
+                self._validate_classifier(fetcher_val, i, 'prune')
                 self.nets.classifier.pruning_switch(True)
                 self.nets.classifier.freeze_switch(False)
+                if cache is not None:
+                    self.nets.classifier.cached_prefix_switch(True)
 
+            if self._should_save_state(i+1):
+                self._save_state('prune', i+1, fetcher, metrics=metrics, memory_bank=memory_bank)
+
+        fetcher.close()
+        if cache is not None:
+            self.nets.classifier.cached_prefix_switch(False)
         # save model checkpoints
-        self._save_checkpoint(step=i+1, token='prune')
+        self._save_checkpoint(step=iters, token='prune', wait=True)
+        self._remove_state('prune')
 
     def retrain(self, iters, freeze=True):
         args = self.args
         nets = self.nets
         optims = self.optims_main # Train only weight parameter
 
-        wrong_label = torch.load(ospj(self.args.checkpoint_dir, 'wrong_index.pth'))
+        wrong_label = self._load_wrong_label()
         print('Number of wrong samples: ', wrong_label.sum())
         upweight = torch.ones_like(wrong_label)
         upweight[wrong_label == 1] = args.lambda_upweight
 
-        upweight_loader = get_original_loader(args, sampling_weight=upweight)
+        upweight_loader = get_original_loader(args, sampling_weight=upweight, salt='retrain')
+        memory_bank = self._memory_bank()
+        metrics = utils.MetricBuffer(runs=self.num_replicas)
+        state = self._load_state('retrain', metrics=metrics, memory_bank=memory_bank)
 
-        fetcher = InputFetcher(upweight_loader)
+        fetcher = self._get_fetcher(upweight_loader, start=state.consumed)
         fetcher_val = self.loaders.val
         start_time = time.time()
 
         self.nets.classifier.pruning_switch(False)
-        self.nets.classifier.freeze_switch(freeze)
+        self.nets.classifier.freeze_switch(freeze, in_place=args.mask_in_place)
 
-        for i in range(iters):
+        for i in range(state.step, iters):
             inputs = next(fetcher)
-            idx, x, label, fname = inputs.index, inputs.x, inputs.y, inputs.fname
-            bias_label = torch.index_select(wrong_label, 0, idx.long())
-
-            pred, feature = self.nets.classifier(x, feature=True)
-            loss_main = self.criterion(pred, label).mean()  #TODO: loss_con
-            loss_con = self.con_criterion(F.normalize(feature, dim=1).unsqueeze(1), label, bias_label)
-            loss = loss_main + args.lambda_con_retrain * loss_con
+            with self.autocast():
+                loss_main, loss_con = self._upweighted_losses(inputs, wrong_label, memory_bank)
+                loss = loss_main + args.lambda_con_retrain * loss_con
 
             self._reset_grad()
             loss.backward()
             optims.classifier.step()
+            metrics.add(loss_main=loss_main, loss_con=loss_con)
 
             # print out log info
             if (i+1) % args.print_every == 0:
                 elapsed = time.time() - start_time
                 elapsed = str(datetime.timedelta(seconds=elapsed))[:-7]
+                losses = metrics.flush() # Means since the last print
                 log = "Elapsed time [%s], Iteration [%i/%i], LR [%.4f], "\
                     "Loss_main [%.6f] Loss_con [%.6f] " % (elapsed, i+1, iters,
                                                            optims.classifier.param_groups[-1]['lr'],
-                                                           loss_main.item(),
-                                                           loss_con.item())
+                                                           losses['loss_main'],
+                                                           losses['loss_con'])
                 print(log)
 
             # save model checkpoints
             if (i+1) % args.save_every_retrain == 0:
                 self._save_checkpoint(step=i+1, token='retrain')
 
-            if (i+1) % args.eval_every_retrain == 0:
-                total_acc, valid_attrwise_acc = self.validation(fetcher_val)
-                self.report_validation(valid_attrwise_acc, total_acc, i, which='retrain')
-                self.valid_logger.append(total_acc.item(), which='retrain')
-                self.valid_logger.append(valid_attrwise_acc, which='groupwise_acc')
+            if (i+1) % args.eval_every_retrain == 0 and distributed.is_main_process():
+                self._validate_classifier(fetcher_val, i, 'retrain', log=True)
 
             if not self.args.no_lr_scheduling:
                 self.scheduler_main.classifier.step()
 
+            if self._should_save_state(i+1):
+                self._save_state('retrain', i+1, fetcher, metrics=metrics, memory_bank=memory_bank)
+
+        fetcher.close()
+        self._remove_state('retrain')
+
     def train(self):
         logging.info('=== Start training ===')
         """
@@ -283,40 +350,45 @@ class PruneSolver(Solver):
         """
 
         args = self.args
-        loader = self.loaders.train
+        loader = self.loaders.train_all
 
         try:
             self._load_checkpoint(args.pretrain_iter, 'pretrain')
             print('Pretrained ckpt exists. Checking upweight index ckpt...')
-        except:
+        except FileNotFoundError:
             print('Start pretraining...')
             self.train_ERM(args.pretrain_iter)
             self._load_checkpoint(args.pretrain_iter, 'pretrain')
+        if args.stop_after == 'pretrain':
+            return
 
+        distributed.barrier() # Every rank checks before rank 0 may create it
         if os.path.exists(ospj(args.checkpoint_dir, 'wrong_index.pth')):
             print('Upweight ckpt exists.')
         else:
             print('Upweight ckpt does not exist. Creating...')
-            if args.pseudo_label_method == 'wrong' or args.mode == 'JTT':
-                if args.earlystop_iter is not None: self._load_checkpoint(args.earlystop_iter, 'pretrain')
+            if distributed.is_main_process():
                 self.save_wrong_idx(loader)
-                self._load_checkpoint(args.pretrain_iter, 'pretrain')
-            else:
-                raise ValueError('No upweight ckpt')
+            distributed.barrier()
 
         assert os.path.exists(ospj(args.checkpoint_dir, 'wrong_index.pth'))
+        if args.stop_after == 'mine':
+            return
 
         if args.mode != 'JTT':
             try:
                 self._load_checkpoint(args.pruning_iter, 'prune')
                 print('Pruning parameter ckpt exists. Start retraining...')
-            except:
+            except FileNotFoundError:
                 print('Pruning parameter ckpt does not exist. Start pruning...')
                 self.train_PRUNE(args.pruning_iter)
 
         self.valid_logger.save()
+        if args.stop_after == 'prune':
+            return
 
         if self.args.reinitialize:
+            self._flush_checkpoints()
             reinit_dict = torch.load(ospj(args.checkpoint_dir, '{:06d}_{}_nets.ckpt'.format(0, 'initial')))['classifier']
             mask_dict = torch.load(ospj(args.checkpoint_dir, '{:06d}_{}_nets.ckpt'.format(args.pruning_iter, 'prune')))['classifier']
             pruning_dict = {k: v for k, v in mask_dict.items() if 'gumbel_pi' in k}
@@ -329,17 +401,60 @@ class PruneSolver(Solver):
 
         self.retrain(args.retrain_iter, freeze=True if args.mode != 'JTT' else False)
         self.valid_logger.save()
+        if args.export_pruned and args.mode != 'JTT' and distributed.is_main_process():
+            _, x, _, _ = next(iter(self.loaders.val))
+            export_pruned(self.nets.classifier, self._pruned_path(), x.to(self.device),
+                          dtype=getattr(torch, args.export_dtype))
         print('Finished training')
 
+    def _pruned_path(self):
+        return ospj(self.args.checkpoint_dir, '{:06d}_pruned.ckpt'.format(self.args.retrain_iter))
+
     def evaluate(self):
         fetcher_val = self.loaders.val
-        self._load_checkpoint(self.args.retrain_iter, 'retrain')
-        print('Load model from ', ospj(self.args.checkpoint_dir, '{:06d}_{}_nets.ckpt'.format(self.args.retrain_iter, 'retrain')))
+        if self.args.export_pruned:
+            load_pruned(self._pruned_path(), self.nets.classifier)
+        else:
+            self._load_checkpoint(self.args.retrain_iter, 'retrain')
+            print('Load model from ', ospj(self.args.checkpoint_dir, '{:06d}_{}_nets.ckpt'.format(self.args.retrain_iter, 'retrain')))
         self.nets.classifier.pruning_switch(False)
         self.nets.classifier.freeze_switch(True)
 
         total_acc, valid_attrwise_acc = self.validation(fetcher_val)
         self.report_validation(valid_attrwise_acc, total_acc, 0, which='Test', save_in_result=True)
 
+        if self.args.compact:
+            self.save_compact_model(fetcher_val)
+        if self.args.sparse_inference:
+            self.save_sparse_model(fetcher_val)
+
         self._tsne(fetcher_val)
 
+    def save_compact_model(self, loader):
+        _, x, _, _ = next(iter(loader))
+        x = x.to(self.device)
+        compact = compact_model(self.nets.classifier, x)
+
+        with torch.no_grad():
+            self.nets.classifier.eval()
+            diff = (self.nets.classifier(x) - compact(x)).abs().max().item()
+            self.nets.classifier.train()
+        print('Compacted classifier: %d -> %d parameters, max logit difference %.2e' % (
+            count_parameters(self.nets.classifier), count_parameters(compact), diff))
+
+        compact_path = ospj(self.args.checkpoint_dir, '{:06d}_compact.pth'.format(self.args.retrain_iter))
+        torch.save(compact, compact_path) # Whole module, since layer shapes changed
+        print('Saved compact model into %s...' % compact_path)
+
+    def save_sparse_model(self, loader):
+        # CPU inference: each layer is stored as CSR if that measures faster than dense
+        _, x, _, _ = next(iter(loader))
+        dense = copy.deepcopy(self.nets.classifier).cpu().eval()
+        sparse, report = sparsify_model(dense, x, max_density=self.args.sparse_max_density)
+        for name, entry in report.items():
+            print('%s: density %.4f, %s' % (name, entry['density'], 'sparse' if entry['sparse'] else 'dense'))
+
+        sparse_path = ospj(self.args.checkpoint_dir, '{:06d}_sparse.pth'.format(self.args.retrain_iter))
+        torch.save(sparse, sparse_path)
+        print('Saved sparse model into %s...' % sparse_path)
+
@@ -0,0 +1,288 @@
+import os
+import copy
+from os.path import join as ospj
+from munch import Munch
+import logging
+
+import torch
+
+from util import distributed
+from util.utils import MultiDimAverageMeter, ValidLogger
+from prune.GateSimpleModel import GateCNN
+from prune.GateLayer import GateMixin
+from prune.Loss import FeatureMemoryBank
+from training.pruning_solver import PruneSolver
+
+
+class ReplicaPruneSolver(PruneSolver):
+    """PruneSolver training one run per seed at once (CMNIST GateCNN, 'wrong' pseudo labels).
+
+    The networks are GroupedGateCNNs holding one GateCNN replica per seed, initialized as
+    the single-seed run would be. Replicas share the data pipeline: pretraining feeds the
+    same batch to all of them, pruning and retraining draw one upweighted batch per replica
+    from a single loader. Losses are summed over replicas, so each replica gets the
+    gradients of its own run. Checkpoints, pseudo labels and validation logs are written
+    per seed, in the directories and formats of single-seed runs. The training loops are
+    those of PruneSolver, through its per-step hooks.
+    """
+    def __init__(self, args, replica_args):
+        if args.data != 'cmnist' or args.cmnist_use_mlp:
+            raise ValueError('Replica training supports the CMNIST GateCNN only')
+        if args.pseudo_label_method != 'wrong':
+            raise ValueError("Replica training supports --pseudo_label_method wrong only")
+        if distributed.is_distributed():
+            raise ValueError('Replica training runs in a single process')
+        if args.export_pruned:
+            raise ValueError('Export the replicas from single-seed runs instead')
+        if args.async_checkpoint or args.keep_last_ckpt is not None:
+            raise ValueError('Replica checkpoints are written synchronously and all kept')
+        if args.mine_topk is not None:
+            raise ValueError('Replica training mines the wrong samples only (no --mine_topk)')
+        self.replica_args = replica_args
+        self.num_replicas = len(replica_args)
+        super(ReplicaPruneSolver, self).__init__(args)
+
+        # Same initialization as the single-seed runs (see main.py and build_model)
+        for name in ['classifier', 'biased_classifier']:
+            state_dicts = []
+            for replica in replica_args:
+                torch.manual_seed(replica.seed)
+                state_dicts.append([GateCNN().state_dict(), GateCNN().state_dict()][name == 'biased_classifier'])
+            self.nets[name].load_replicas(state_dicts)
+
+        self.replica_loggers = [ValidLogger(ospj(replica.log_dir, f'valid_acc_{args.pruning_iter}.pkl'))
+                                for replica in replica_args]
+        for replica in replica_args[1:]: # args logs into the directories of the first seed
+            logging.getLogger().addHandler(logging.FileHandler(ospj(replica.log_dir, 'training.log')))
+
+    @property
+    def valid_loggers(self):
+        return self.replica_loggers
+
+    def _state_path(self, token):
+        seeds = '_'.join(str(replica.seed) for replica in self.replica_args)
+        return ospj(self.args.checkpoint_dir, f'{token}_seeds_{seeds}_state.ckpt')
+
+    def _checkpoint_path(self, replica, step, token):
+        return ospj(replica.checkpoint_dir, '{:06d}_{}_nets.ckpt'.format(step, token))
+
+    def _save_checkpoint(self, step, token, wait=False):
+        replica_states = {name: net.replica_state_dicts() for name, net in self.nets.items()}
+        for k, replica in enumerate(self.replica_args):
+            fname = self._checkpoint_path(replica, step, token)
+            print('Saving checkpoint into %s...' % fname)
+            torch.save({name: states[k] for name, states in replica_states.items()}, fname)
+
+    def _load_replica_states(self, step, token):
+        states = []
+        for replica in self.replica_args:
+            fname = self._checkpoint_path(replica, step, token)
+            print('Loading checkpoint from %s...' % fname)
+            states.append(torch.load(fname, map_location=self.device))
+        return states
+
+    def _load_checkpoint(self, step, token, which=None, return_fname=False):
+        states = self._load_replica_states(step, token)
+        for name, net in self.nets.items():
+            if which is None or which == name:
+                net.load_replicas([state[name] for state in states])
+
+    def _replica_loss(self, criterion, pred, label):
+        # Sum over replicas of each replica's mean loss. pred: [B, K, C], label: [B, K]
+        loss = criterion(pred.flatten(0, 1), label.flatten())
+        return loss.view(label.shape).mean(0).sum()
+
+    def _split_replicas(self, inputs, wrong_labels):
+        # K concatenated batches -> [B, K, ...]
+        k = self.num_replicas
+        split = lambda t: t.view(k, -1, *t.shape[1:]).transpose(0, 1)
+        idx, x, label = split(inputs.index), split(inputs.x), split(inputs.y)
+        bias_label = wrong_labels.gather(1, idx.t().long()).t()
+        return idx, x, label, bias_label
+
+    def evaluate_replicas(self, loader, which='main', return_logits=False):
+        """evaluate_models() for every replica in one pass. Returns a list of Munch."""
+        net = self.nets.classifier if which == 'main' else self.nets.biased_classifier
+        net.eval()
+        meters = [MultiDimAverageMeter(self.attr_dims) for _ in range(self.num_replicas)]
+        total_correct = torch.zeros(self.num_replicas, device=self.device)
+        total_num = 0
+        if return_logits:
+            num_data = len(loader.dataset)
+            logits = torch.zeros(num_data, self.num_replicas, self.num_classes, device=self.device)
+            attrs = torch.zeros(num_data, 2, dtype=torch.long, device=self.device)
+
+        for idx, data, attr, _ in loader:
+            attr = attr[:, [0, 1]].to(self.device)
+            label = attr[:, 0]
+            with torch.no_grad(), self.autocast():
+                logit = net(data.to(self.device))
+            correct = (logit.argmax(2) == label.unsqueeze(1)).long()
+            total_correct += correct.sum(0)
+            for k in range(self.num_replicas):
+                meters[k].add(correct[:, k], attr)
+            total_num += label.shape[0]
+            if return_logits:
+                logits[idx.to(self.device)] = logit.float()
+                attrs[idx.to(self.device)] = attr
+        net.train()
+
+        results = []
+        for k in range(self.num_replicas):
+            result = Munch(total_acc=total_correct[k] / float(total_num),
+                           attrwise_acc=meters[k].get_mean())
+            if return_logits:
+                result.logits, result.attr = logits[:, k], attrs
+            results.append(result)
+        return results
+
+    def report_replicas(self, results, step, which, log_key=None):
+        for k, (replica, result) in enumerate(zip(self.replica_args, results)):
+            self.report_validation(result.attrwise_acc, result.total_acc, step,
+                                   which=f'{which} seed {replica.seed}')
+            if log_key is not None:
+                self.valid_loggers[k].append(result.total_acc.item(), which=log_key)
+
+    def active_ratio_replicas(self):
+        # Returns [(ratio, layerwise)] of each replica
+        active, total = 0, 0
+        layerwise = [{} for _ in range(self.num_replicas)]
+        for name, m in self.nets.classifier.named_modules():
+            if isinstance(m, GateMixin):
+                pi = m.mask.gumbel_pi.view(self.num_replicas, -1) # Replica-major in every gate layer
+                active_n = (pi >= 0).sum(1)
+                for k, a in enumerate(active_n.tolist()):
+                    layerwise[k][f'{name}.mask.gumbel_pi'] = a / pi.shape[1]
+                    if a == 0: print('Warning: Dead layer')
+                active, total = active + active_n, total + pi.shape[1]
+        return [(a / total, l) for a, l in zip(active.tolist(), layerwise)]
+
+    def _erm_losses(self, inputs):
+        # The same batch for every replica
+        x, label = inputs.x, inputs.y.unsqueeze(1).expand(-1, self.num_replicas)
+        pred = self.train_nets.classifier(x)
+        pred_bias = self.train_nets.biased_classifier(x)
+        bias_criterion = self.bias_criterion if self.args.select_with_GCE else self.criterion
+        return (self._replica_loss(self.criterion, pred, label),
+                self._replica_loss(bias_criterion, pred_bias, label))
+
+    def _validate_erm(self, loader, step):
+        self.report_replicas(self.evaluate_replicas(loader, 'main'), step, 'main', log_key='ERM')
+        self.report_replicas(self.evaluate_replicas(loader, 'bias'), step, 'bias')
+
+    def update_pseudo_label(self, bias_score_array, loader, iters, pseudo_every):
+        # Only used by --pseudo_label_method ensemble
+        return bias_score_array, None
+
+    def save_wrong_idx(self, loader):
+        which = 'bias' if self.args.select_with_GCE else 'main'
+        for replica, result in zip(self.replica_args, self.evaluate_replicas(loader, which, return_logits=True)):
+            label, bias_label = result.attr[:, 0], result.attr[:, 1]
+            wrong_label = (result.logits.argmax(1) != label).float()
+            debias_label = (label != bias_label).float()
+            print(f'Seed {replica.seed}. Number of wrong samples: ', wrong_label.sum())
+            self.confirm_pseudo_label(wrong_label, debias_label, replica.checkpoint_dir)
+
+    def _load_wrong_label(self):
+        # [K, N]: the upweighted loaders then draw one batch per replica
+        return torch.stack([torch.load(ospj(replica.checkpoint_dir, 'wrong_index.pth'), map_location=self.device)
+                            for replica in self.replica_args])
+
+    def _memory_bank(self):
+        if self.args.memory_bank_size == 0:
+            return None
+        return _MemoryBanks(FeatureMemoryBank(self.args.memory_bank_size) for _ in range(self.num_replicas))
+
+    def _upweighted_losses(self, inputs, wrong_label, memory_bank):
+        idx, x, label, bias_label = self._split_replicas(inputs, wrong_label)
+        pred, feature = self.train_nets.classifier(x, feature=True)
+        loss_main = self._replica_loss(self.criterion, pred, label)
+        loss_con = sum(self.contrastive_loss(feature[:, k], label[:, k], bias_label[:, k], idx[:, k],
+                                             memory_bank[k] if memory_bank is not None else None)
+                       for k in range(self.num_replicas))
+        return loss_main, loss_con
+
+    def _log_active_ratio(self):
+        for k, (ratio, layerwise) in enumerate(self.active_ratio_replicas()):
+            print(f'seed {self.replica_args[k].seed} ratio:', ratio)
+            self.replica_loggers[k].append(ratio, which='ratio')
+            self.replica_loggers[k].append(layerwise, which='layerwise_ratio')
+
+    def _validate_classifier(self, loader, step, which, log=False):
+        results = self.evaluate_replicas(loader)
+        self.report_replicas(results, step, which, log_key=which if log else None)
+        if log:
+            for logger, result in zip(self.replica_loggers, results):
+                logger.append(result.attrwise_acc, which='groupwise_acc')
+
+    def train(self):
+        logging.info('=== Start training ===')
+        args = self.args
+
+        try:
+            self._load_checkpoint(args.pretrain_iter, 'pretrain')
+            print('Pretrained ckpt exists. Checking upweight index ckpt...')
+        except FileNotFoundError:
+            print('Start pretraining...')
+            self.train_ERM(args.pretrain_iter)
+            self._load_checkpoint(args.pretrain_iter, 'pretrain')
+        if args.stop_after == 'pretrain':
+            return
+
+        if all(os.path.exists(ospj(replica.checkpoint_dir, 'wrong_index.pth')) for replica in self.replica_args):
+            print('Upweight ckpt exists.')
+        else:
+            print('Upweight ckpt does not exist. Creating...')
+            if args.earlystop_iter is not None: self._load_checkpoint(args.earlystop_iter, 'pretrain')
+            self.save_wrong_idx(self.loaders.train_all)
+            self._load_checkpoint(args.pretrain_iter, 'pretrain')
+        if args.stop_after == 'mine':
+            return
+
+        try:
+            self._load_checkpoint(args.pruning_iter, 'prune')
+            print('Pruning parameter ckpt exists. Start retraining...')
+        except FileNotFoundError:
+            print('Pruning parameter ckpt does not exist. Start pruning...')
+            self.train_PRUNE(args.pruning_iter)
+
+        for logger in self.valid_loggers:
+            logger.save()
+        if args.stop_after == 'prune':
+            return
+
+        if self.args.reinitialize:
+            initial = self._load_replica_states(0, 'initial')
+            pruned = self._load_replica_states(args.pruning_iter, 'prune')
+            state_dicts = []
+            for init_state, prune_state in zip(initial, pruned):
+                state = init_state['classifier']
+                state.update({k: v for k, v in prune_state['classifier'].items() if 'gumbel_pi' in k})
+                state_dicts.append(state)
+            self.nets.classifier.load_replicas(state_dicts)
+            print('Reinitialized models from their initial checkpoints')
+
+        self.retrain(args.retrain_iter, freeze=True)
+        for logger in self.valid_loggers:
+            logger.save()
+        print('Finished training')
+
+    def evaluate(self):
+        # Replica checkpoints are GateCNN checkpoints: test every seed with PruneSolver
+        for replica in self.replica_args:
+            replica = copy.copy(replica)
+            replica.seeds = None
+            torch.manual_seed(replica.seed)
+            solver = PruneSolver(replica)
+            solver.evaluate()
+            solver.close()
+
+
+class _MemoryBanks(list):
+    # One FeatureMemoryBank per replica, saved in training states as one object
+    def state_dict(self):
+        return [bank.state_dict() for bank in self]
+
+    def load_state_dict(self, state_dicts):
+        for bank, state_dict in zip(self, state_dicts):
+            bank.load_state_dict(state_dict)
@@ -8,21 +8,38 @@ import pickle as pkl
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from sklearn.manifold import TSNE
-from util.checkpoint import CheckpointIO
+from util.checkpoint import CheckpointIO, AsyncCheckpointIO
+from util.storage import atomic_save
+from util import distributed
 import util.utils as utils
 from data.transforms import num_classes
 
-from util.utils import MultiDimAverageMeter, ValidLogger
-from data.data_loader import InputFetcher
+from util.utils import MultiDimAverageMeter, ValidLogger, MetricBuffer
+from data.data_loader import InputFetcher, PrefetchInputFetcher
 from model.build_models import build_model
 from training.loss import GeneralizedCELoss
+from training.mining import bias_score, save_scores, score_path
+from prune.Compile import compile_phases
 
-from data.data_loader import get_original_loader, get_val_loader
+from data.data_loader import get_original_loader, get_sequential_loader, get_val_loader
+
+
+def _to_cpu(obj):
+    if torch.is_tensor(obj):
+        return obj.cpu()
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
 
 
 class Solver(nn.Module):
+    num_replicas = 1 # Runs trained together, see ReplicaPruneSolver
+
     def __init__(self, args):
         super().__init__()
         self.args = args
@@ -59,9 +76,17 @@ class Solver(nn.Module):
                 self.scheduler[net] = torch.optim.lr_scheduler.StepLR(
                     self.optims[net], step_size=args.lr_decay_step_pre, gamma=args.lr_gamma_pre)
 
+        # Checkpoints the pipeline loads again are never removed by --keep_last_ckpt
+        keep = [(0, 'initial'), (args.pretrain_iter, 'pretrain'), (args.earlystop_iter, 'pretrain'),
+                (args.pruning_iter, 'prune'), (args.retrain_iter, 'retrain')]
+        ckptio_class, ckptio_kwargs = CheckpointIO, {}
+        if args.async_checkpoint:
+            ckptio_class, ckptio_kwargs = AsyncCheckpointIO, dict(max_pending=args.max_pending_ckpt)
         self.ckptios = [
-            CheckpointIO(ospj(args.checkpoint_dir, '{:06d}_{}_nets.ckpt'), **self.nets),
+            ckptio_class(ospj(args.checkpoint_dir, '{:06d}_{}_nets.ckpt'), keep_last=args.keep_last_ckpt,
+                         keep=keep, **ckptio_kwargs, **self.nets),
         ]
+        self.fetchers = [] # Closed by close(), even when a training loop raised
         logging.basicConfig(filename=os.path.join(args.log_dir, 'training.log'),
                             level=logging.INFO)
 
@@ -72,13 +97,29 @@ class Solver(nn.Module):
         self.tsne = TSNE(n_components=2, perplexity=20, init='pca', n_iter=3000)
 
         self.to(self.device)
-        self.bias_criterion = GeneralizedCELoss()
+        if args.compile:
+            for net in self.nets.values():
+                compile_phases(net)
+        self.train_nets = distributed.wrap_models(self.nets) # Used for the forwards of training steps
+        self.bias_criterion = GeneralizedCELoss(nan_check_every=args.nan_check_every)
         self.criterion = nn.CrossEntropyLoss(reduction='none')
 
         # BUILD LOADERS
         self.loaders = Munch(train=get_original_loader(args),
-                             val=get_val_loader(args),
-                             trainset=get_original_loader(args, return_dataset=True))
+                             val=get_val_loader(args))
+        self.loaders.trainset = self.loaders.train.dataset.dataset # Unwrap IdxDataset
+        # Whole training set, for pseudo labels and mining on rank 0. Own loader, so that
+        # passes over it leave the order of the training batches unchanged
+        self.loaders.train_all = get_sequential_loader(args, self.loaders.train)
+
+    @property
+    def valid_loggers(self):
+        return [self.valid_logger]
+
+    def autocast(self):
+        # bf16 autocast of forwards and losses with --amp. Mask sampling, the contrastive
+        # loss and GCE opt out and stay in fp32
+        return torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.args.amp)
 
     def _reset_grad(self):
         def _recursive_reset(optims_dict):
@@ -89,98 +130,153 @@ class Solver(nn.Module):
                     optim.zero_grad()
         return _recursive_reset(self.optims)
 
-    def _save_checkpoint(self, step, token):
+    def _get_fetcher(self, loader, start=0):
+        if self.args.num_prefetch > 0:
+            fetcher = PrefetchInputFetcher(loader, self.args.num_prefetch, start=start)
+        else:
+            fetcher = InputFetcher(loader, start=start)
+        self.fetchers.append(fetcher)
+        return fetcher
+
+    def _stateful(self):
+        # Optimizers and LR schedulers saved in training states, by group
+        return Munch(optims=self.optims, scheduler=self.scheduler)
+
+    def _state_path(self, token):
+        return ospj(self.args.checkpoint_dir, f'{token}_state.ckpt')
+
+    def _save_state(self, token, step, fetcher, **loop_state):
+        """Save what phase `token` needs to continue after `step` as if uninterrupted: the
+        networks, optimizers and schedulers, the number of batches taken from `fetcher`, the
+        validation log and, for every rank, its RNG states and `loop_state` (objects with a
+        state_dict(), or tensors, of the training loop)."""
+        loop = {k: v.state_dict() if hasattr(v, 'state_dict') else v for k, v in loop_state.items()}
+        local = distributed.all_gather_object(_to_cpu(dict(rng=utils.get_rng_state(), loop=loop)))
+        if distributed.is_main_process():
+            state = dict(step=step, consumed=fetcher.consumed, local=local,
+                         valid_log=[logger.log for logger in self.valid_loggers],
+                         nets={name: net.state_dict() for name, net in self.nets.items()},
+                         stateful={group: {name: obj.state_dict() for name, obj in objs.items()}
+                                   for group, objs in self._stateful().items()})
+            fname = self._state_path(token)
+            atomic_save(fname, lambda tmp: torch.save(state, tmp))
+            print('Saved training state of step %d into %s...' % (step, fname))
+        distributed.barrier()
+
+    def _load_state(self, token, **loop_state):
+        """Restore the state saved by _save_state(token, ...) if there is one. Objects in
+        `loop_state` load their saved state; returns Munch(step, consumed, loop) where loop
+        holds the saved tensors. step and consumed are 0 without a saved state."""
+        fname = self._state_path(token)
+        if not os.path.exists(fname):
+            return Munch(step=0, consumed=0, loop={})
+        print('Resuming %s from %s...' % (token, fname))
+        state = torch.load(fname, map_location=self.device, weights_only=False)
+        for name, net in self.nets.items():
+            net.load_state_dict(state['nets'][name])
+        for group, objs in self._stateful().items():
+            for name, obj in objs.items():
+                obj.load_state_dict(state['stateful'][group][name])
+        local = state['local'][distributed.get_rank() % len(state['local'])]
+        for k, obj in loop_state.items():
+            if obj is not None:
+                obj.load_state_dict(local['loop'][k])
+        for logger, log in zip(self.valid_loggers, state['valid_log']):
+            logger.log = log
+        utils.set_rng_state(local['rng'])
+        return Munch(step=state['step'], consumed=state['consumed'], loop=local['loop'])
+
+    def _remove_state(self, token):
+        # The phase is over: its checkpoint replaces the state
+        if distributed.is_main_process() and os.path.exists(self._state_path(token)):
+            os.remove(self._state_path(token))
+
+    def _should_save_state(self, step):
+        return self.args.save_state_every > 0 and step % self.args.save_state_every == 0
+
+    def _save_checkpoint(self, step, token, wait=False):
+        # wait: the other ranks load this checkpoint after the barrier
+        if distributed.is_main_process():
+            for ckptio in self.ckptios:
+                ckptio.save(step, token)
+                if wait and distributed.is_distributed():
+                    ckptio.flush()
+        distributed.barrier()
+
+    def _flush_checkpoints(self):
+        for ckptio in self.ckptios:
+            ckptio.flush()
+
+    def close(self):
+        # Stops the prefetch threads and waits for the checkpoints still being written
+        while self.fetchers:
+            self.fetchers.pop().close()
         for ckptio in self.ckptios:
-            ckptio.save(step, token)
+            ckptio.close()
 
     def _load_checkpoint(self, step, token, which=None, return_fname=False):
         for ckptio in self.ckptios:
             ckptio.load(step, token, which, return_fname)
 
     def update_pseudo_label(self, bias_score_array, loader, iters, pseudo_every):
-        self.nets.biased_classifier.eval()
-
-        iterator = enumerate(loader)
-        debias_idx = torch.empty(0).to(self.device)
-
-        for _, (idx, data, attr, fname) in iterator:
-            idx = idx.to(self.device)
-            label = attr[:, 0].to(self.device)
-            bias_label = attr[:, 1].to(self.device)
+        results = self.evaluate_models(loader, ['bias'], return_logits=True)
+        label = results.attr[:, 0]
+
+        bias_score_array += bias_score(results.bias.logits, label) * (pseudo_every / iters)
+        return bias_score_array, results.attr
+
+    def evaluate_models(self, loader, which=('main',), return_logits=False):
+        """Stream `loader` once and run every requested network on each batch.
+        which: 'main' for the classifier, anything else for the biased classifier.
+        Returns a Munch per network with total_acc and attrwise_acc. With return_logits,
+        each also holds logits [N, C] and results.attr holds attr [N, 2], ordered by
+        dataset index."""
+        local_classifiers = {key: self.nets.classifier if key == 'main' else self.nets.biased_classifier
+                             for key in which}
+        for local_classifier in local_classifiers.values():
+            local_classifier.eval()
+
+        attrwise_acc_meters = {key: MultiDimAverageMeter(self.attr_dims) for key in which}
+        total_correct = {key: 0 for key in which}
+        total_num = 0
+        if return_logits:
+            num_data = len(loader.dataset)
+            logits = {key: torch.zeros(num_data, self.num_classes, device=self.device) for key in which}
+            attrs = torch.zeros(num_data, 2, dtype=torch.long, device=self.device)
+
+        for idx, data, attr, _ in loader:
+            attr = attr[:, [0, 1]].to(self.device)
+            label = attr[:, 0]
             data = data.to(self.device)
-            debiased = (label != bias_label).long()
 
             with torch.no_grad():
-                logit = self.nets.biased_classifier(data)
-                bias_prob = nn.Softmax()(logit)[torch.arange(logit.size(0)), label]
-                bias_score = 1 - bias_prob
-
-                for i, v in enumerate(idx):
-                    bias_score_array[v] += bias_score[i] * pseudo_every / iters
-
-                debias_idx = torch.cat((debias_idx, idx[debiased == 1])).long()
-        self.nets.biased_classifier.train()
-
-        return bias_score_array, debias_idx
-
-    def confirm_pseudo_label_(self, bias_score_array, debias_idx, total_num):
-        pseudo_label = (bias_score_array > self.args.tau).long()
-        debias_label = torch.zeros(total_num).to(self.device)
-
-        for idx in debias_idx:
-            debias_label[idx] = 1
-
-        spur_precision = torch.sum(
-                (pseudo_label == 1) & (debias_label == 1)
-            ) / torch.sum(pseudo_label)
-        print("Spurious precision", spur_precision)
-        spur_recall = torch.sum(
-                (pseudo_label == 1) & (debias_label == 1)
-            ) / torch.sum(debias_label)
-        print("Spurious recall", spur_recall)
-
-        wrong_idx_path = ospj(self.args.checkpoint_dir, 'wrong_index.pth')
-
-        if not self.args.supervised:
-            torch.save(pseudo_label, wrong_idx_path)
-        else:
-            torch.save(debias_label, wrong_idx_path)
-        print('Saved pseudo label.')
-        self.nets.classifier.train()
-        self.nets.biased_classifier.train()
+                for key, local_classifier in local_classifiers.items():
+                    with self.autocast():
+                        logit = local_classifier(data)
+                    correct = (logit.argmax(1) == label).long()
+                    total_correct[key] += correct.sum()
+                    attrwise_acc_meters[key].add(correct, attr)
+                    if return_logits:
+                        logits[key][idx.to(self.device)] = logit.float()
+
+            total_num += label.shape[0]
+            if return_logits:
+                attrs[idx.to(self.device)] = attr
+
+        results = Munch()
+        for key, local_classifier in local_classifiers.items():
+            local_classifier.train()
+            results[key] = Munch(total_acc=total_correct[key] / float(total_num),
+                                 attrwise_acc=attrwise_acc_meters[key].get_mean())
+            if return_logits:
+                results[key].logits = logits[key]
+        if return_logits:
+            results.attr = attrs
+        return results
 
     def validation(self, fetcher, which='main'):
-        if which == 'main':
-            local_classifier = self.nets.classifier
-        else:
-            local_classifier = self.nets.biased_classifier
-        local_classifier = local_classifier.eval()
-
-        attrwise_acc_meter = MultiDimAverageMeter(self.attr_dims)
-        iterator = enumerate(fetcher)
-
-        total_correct, total_num = 0, 0
-
-        for index, (_, data, attr, fname) in iterator:
-            label = attr[:, 0].to(self.device)
-            data = data.to(self.device)
-
-            with torch.no_grad():
-                logit = local_classifier(data)
-                pred = logit.data.max(1, keepdim=True)[1].squeeze(1)
-                correct = (pred == label).long()
-
-                total_correct += correct.sum()
-                total_num += correct.shape[0]
-
-            attr = attr[:, [0, 1]]
-            attrwise_acc_meter.add(correct.cpu(), attr.cpu())
-
-        total_acc = total_correct / float(total_num)
-        accs = attrwise_acc_meter.get_mean()
-
-        local_classifier = local_classifier.train()
-        return total_acc, accs
+        results = self.evaluate_models(fetcher, [which])
+        return results[which].total_acc, results[which].attrwise_acc
 
     def report_validation(self, valid_attrwise_acc, valid_acc,
                           step=0, which='bias', save_in_result=False):
@@ -200,48 +296,69 @@ class Solver(nn.Module):
             with open(os.path.join(self.args.result_dir, 'test.txt'), "a") as f:
                 f.write(log)
 
+    def _erm_losses(self, inputs):
+        # (loss of the classifier, loss of the biased classifier) of a pretraining step
+        args = self.args
+        x, label = inputs.x, inputs.y
+        pred = self.train_nets.classifier(x)
+        pred_bias = self.train_nets.biased_classifier(x)
+
+        loss = self.criterion(pred, label).mean()
+        if args.pseudo_label_method == 'ensemble':
+            loss_bias = self.criterion(pred_bias, label)
+            bias_prob = F.softmax(pred_bias, dim=1).gather(1, label.unsqueeze(1)).squeeze(1)
+            confident = (bias_prob > args.eta).float() # Choose samples with high confidence
+            # Masked mean: no gradient (as for an empty selection) when nothing is confident
+            loss_bias = (loss_bias * confident).sum() / confident.sum().clamp(min=1)
+        else:
+            if args.select_with_GCE:
+                loss_bias = self.bias_criterion(pred_bias, label).mean()
+            else:
+                loss_bias = self.criterion(pred_bias, label).mean()
+        return loss, loss_bias
+
+    def _validate_erm(self, loader, step):
+        results = self.evaluate_models(loader, ['main', 'bias'])
+        self.report_validation(results.main.attrwise_acc, results.main.total_acc, step, which='main')
+        self.valid_logger.append(results.main.total_acc.item(), which='ERM')
+        self.report_validation(results.bias.attrwise_acc, results.bias.total_acc, step, which='bias')
+
     def train_ERM(self, iters):
         logging.info('=== Start training ===')
         args = self.args
         nets = self.nets
         optims = self.optims
 
-        fetcher = InputFetcher(self.loaders.train)
         fetcher_val = self.loaders.val
-        fetcher_train = self.loaders.train
+        fetcher_train = self.loaders.train_all
 
         total_num = len(self.loaders.trainset)
         bias_score_array = torch.zeros(total_num).to(self.device)
+        attr = None
         pseudo_every = int(total_num / args.batch_size)
 
         start_time = time.time()
+        metrics = MetricBuffer(runs=self.num_replicas)
 
-        self._save_checkpoint(step=0, token='initial')
+        state = self._load_state('pretrain', metrics=metrics)
+        if state.step == 0:
+            self._save_checkpoint(step=0, token='initial')
+        else:
+            bias_score_array, attr = state.loop['bias_score_array'], state.loop['attr']
+        fetcher = self._get_fetcher(self.loaders.train, start=state.consumed)
 
-        for i in range(iters):
+        for i in range(state.step, iters):
             # fetch images and labels
             inputs = next(fetcher)
-            idx, x, label, fname = inputs.index, inputs.x, inputs.y, inputs.fname
-
-            pred = self.nets.classifier(x)
-            pred_bias = self.nets.biased_classifier(x)
-
-            loss = self.criterion(pred, label).mean()
-            if args.pseudo_label_method == 'ensemble':
-                loss_bias = self.criterion(pred_bias, label)
-                bias_prob = nn.Softmax()(pred_bias)[torch.arange(pred_bias.size(0)), label]
-                loss_bias = loss_bias[bias_prob > args.eta].mean() # Choose samples with high confidence
-            else:
-                if args.select_with_GCE:
-                    loss_bias = self.bias_criterion(pred_bias, label).mean()
-                else:
-                    loss_bias = self.criterion(pred_bias, label).mean()
+            with self.autocast():
+                loss, loss_bias = self._erm_losses(inputs)
 
             self._reset_grad()
             loss.backward()
             loss_bias.backward()
             optims.classifier.step()
             optims.biased_classifier.step()
+            metrics.add(**{'Debiased/': loss, 'Biased/': loss_bias})
 
             # print out log info
             if (i+1) % args.print_every == 0:
@@ -250,24 +367,16 @@ class Solver(nn.Module):
                 log = "Elapsed time [%s], Iteration [%i/%i], LR [%.4f]" % (elapsed, i+1, iters,
                                                                            optims.classifier.param_groups[-1]['lr'])
 
-                all_losses = dict()
-                for loss, key in zip([loss.item(), loss_bias.item()], ['Debiased/',
-                                                                       'Biased/']):
-                    all_losses[key] = loss
+                all_losses = metrics.flush() # Means since the last print
                 log += ' '.join(['%s: [%f]' % (key, value) for key, value in all_losses.items()])
                 print(log)
                 logging.info(log)
 
-            if (i+1) % args.eval_every == 0:
-                total_acc, valid_attrwise_acc = self.validation(fetcher_val)
-                self.report_validation(valid_attrwise_acc, total_acc, i, which='main')
-                self.valid_logger.append(total_acc.item(), which='ERM')
-
-                total_acc_b, valid_attrwise_acc_b = self.validation(fetcher_val, which='bias')
-                self.report_validation(valid_attrwise_acc_b, total_acc_b, i, which='bias')
+            if (i+1) % args.eval_every == 0 and distributed.is_main_process():
+                self._validate_erm(fetcher_val, i)
 
-            if (i+1) % pseudo_every == 0:
-                bias_score_array, debias_idx = self.update_pseudo_label(bias_score_array, fetcher_train, iters, pseudo_every)
+            if (i+1) % pseudo_every == 0 and distributed.is_main_process():
+                bias_score_array, attr = self.update_pseudo_label(bias_score_array, fetcher_train, iters, pseudo_every)
 
             if (i+1) % args.save_every == 0:
                 self._save_checkpoint(step=i+1, token='pretrain')
@@ -276,13 +385,21 @@ class Solver(nn.Module):
                 self.scheduler.classifier.step()
                 self.scheduler.biased_classifier.step()
 
-        if args.pseudo_label_method == 'ensemble':
-            self.confirm_pseudo_label_(bias_score_array, debias_idx, total_num)
+            if self._should_save_state(i+1):
+                self._save_state('pretrain', i+1, fetcher, metrics=metrics,
+                                 bias_score_array=bias_score_array, attr=attr)
+
+        fetcher.close()
+        if args.pseudo_label_method == 'ensemble' and distributed.is_main_process():
+            # Mined with tau later (training/mining.py)
+            save_scores(score_path(args.checkpoint_dir, iters), attr=attr, ensemble=bias_score_array)
 
-        self.valid_logger.save()
+        for logger in self.valid_loggers:
+            logger.save()
 
         # save model checkpoints
-        self._save_checkpoint(step=i+1, token='pretrain')
+        self._save_checkpoint(step=iters, token='pretrain', wait=True)
+        self._remove_state('pretrain')
 
     def train(self):
         self.train_ERM(self.args.pretrain_iter)
@@ -9,14 +9,27 @@ Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
 """
 
 import os
+import queue
+import atexit
+import threading
+import numpy as np
 import torch
 
+from util.storage import atomic_save
+from prune.GateLayer import GateMixin
+from prune.Compact import masked_layers, compact_model
+
 
 class CheckpointIO(object):
-    def __init__(self, fname_template, **kwargs):
+    """With `keep_last`, only the last keep_last checkpoints of each token written by this
+    object are kept on disk, except those listed in `keep` as (step, token)."""
+    def __init__(self, fname_template, keep_last=None, keep=(), **kwargs):
         os.makedirs(os.path.dirname(fname_template), exist_ok=True)
         self.fname_template = fname_template
         self.module_dict = kwargs
+        self.keep_last = keep_last
+        self.keep = set(keep)
+        self.saved = {} # token: steps written, oldest first
 
     def register(self, **kwargs):
         self.module_dict.update(kwargs)
@@ -34,9 +47,30 @@ class CheckpointIO(object):
         outdict = {}
         for name, module in self.module_dict.items():
             outdict[name] = module.state_dict()
-        torch.save(outdict, fname)
+        atomic_save(fname, lambda tmp: torch.save(outdict, tmp))
+        self._retain(step, token)
+
+    def _retain(self, step, token):
+        if self.keep_last is None:
+            return
+        saved = self.saved.setdefault(token, [])
+        if step not in saved:
+            saved.append(step)
+        removable = [s for s in saved if (s, token) not in self.keep]
+        for old in removable[:-self.keep_last] if self.keep_last > 0 else removable:
+            fname = self.fname_template.format(old, token)
+            if os.path.exists(fname):
+                os.remove(fname)
+            saved.remove(old)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
 
     def load(self, step, token, which=None, return_fname=False):
+        self.flush()
         fname = self.fname_template.format(step, token)
         if not os.path.exists(fname): print(f'WARNING: {fname} does not exist!')
         if return_fname: return fname
@@ -54,3 +88,147 @@ class CheckpointIO(object):
         for name, module in self.module_dict.items():
             module.load_state_dict(module_dict[name])
 
+
+class AsyncCheckpointIO(CheckpointIO):
+    """CheckpointIO whose save() only snapshots the state dicts to host memory (pinned, with
+    non-blocking copies on CUDA) and leaves serialization to a background thread. At most
+    `max_pending` checkpoints wait to be written; save() blocks while the queue is full.
+    Files are written under a temporary name and renamed when complete. load() and
+    flush() wait for the pending writes; errors of the writer are raised by the next call."""
+    def __init__(self, fname_template, max_pending=2, keep_last=None, keep=(), **kwargs):
+        super(AsyncCheckpointIO, self).__init__(fname_template, keep_last, keep, **kwargs)
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.buffers = [] # Host snapshots to reuse, returned by the writer
+        self.error = None
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _snapshot(self):
+        buffer = self.buffers.pop() if self.buffers else {}
+        pin = torch.cuda.is_available()
+        outdict = {}
+        for name, module in self.module_dict.items():
+            host = buffer.get(name, {})
+            outdict[name] = {}
+            for k, v in module.state_dict().items():
+                if not torch.is_tensor(v):
+                    outdict[name][k] = v
+                    continue
+                out = host.get(k)
+                if out is None or out.shape != v.shape or out.dtype != v.dtype:
+                    out = torch.empty(v.shape, dtype=v.dtype, pin_memory=pin)
+                outdict[name][k] = out.copy_(v.detach(), non_blocking=True)
+        event = None
+        if pin:
+            event = torch.cuda.Event()
+            event.record()
+        return outdict, event
+
+    def save(self, step, token):
+        self._raise_error()
+        fname = self.fname_template.format(step, token)
+        print('Saving checkpoint into %s...' % fname)
+        outdict, event = self._snapshot()
+        self.queue.put((step, token, outdict, event))
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                step, token, outdict, event = item
+                if event is not None:
+                    event.synchronize()
+                atomic_save(self.fname_template.format(step, token), lambda tmp: torch.save(outdict, tmp))
+                self.buffers.append(outdict)
+                self._retain(step, token)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
+
+
+def _gate_layers(model):
+    return {name: m for name, m in model.named_modules() if isinstance(m, GateMixin)}
+
+
+def export_pruned(model, fname, example_input, dtype=None):
+    """Save a frozen Gate network with only its surviving weights.
+
+    Each gate layer keeps a bit-packed mask and the weights the mask keeps; layers that
+    run without their mask (traced with `example_input`) keep their dense weight. gumbel_pi
+    is dropped. Floating point parameters are cast to `dtype` if given, buffers stay as is.
+    """
+    pruning, freeze = model.pruning, model.freeze
+    model.pruning_switch(False)
+    model.freeze_switch(True)
+    masked = masked_layers(model, example_input)
+    model.pruning_switch(pruning)
+    model.freeze_switch(freeze)
+
+    cast = lambda t: t.to(dtype) if dtype is not None and t.is_floating_point() else t
+    state = model.state_dict()
+    layers = {}
+    for name, layer in _gate_layers(model).items():
+        prefix = f'{name}.' if name else ''
+        mask = layer.mask.fix_mask_after_pruning().bool().cpu()
+        weight = state.pop(prefix + 'weight').cpu()
+        state.pop(prefix + 'mask.gumbel_pi')
+        entry = dict(shape=tuple(mask.shape),
+                     mask=torch.from_numpy(np.packbits(mask.flatten().numpy())))
+        if layer in masked:
+            entry['values'] = cast(weight[mask])
+        else:
+            entry['weight'] = cast(weight)
+        layers[name] = entry
+
+    param_names = {n for n, _ in model.named_parameters()}
+    state = {k: cast(v.cpu()) if k in param_names else v.cpu() for k, v in state.items()}
+    torch.save({'layers': layers, 'state': state}, fname)
+    print('Exported pruned model into %s...' % fname)
+
+
+def load_pruned(fname, model, compact=False, example_input=None):
+    """Load an export_pruned() file into `model`, a Gate network of the same architecture.
+    gumbel_pi is rebuilt as +-1.5 from the masks, so the frozen forward is unchanged.
+    With `compact`, return compact_model(model, example_input) instead."""
+    checkpoint = torch.load(fname, map_location='cpu')
+    state = dict(checkpoint['state'])
+    gate_layers = _gate_layers(model)
+    for name, entry in checkpoint['layers'].items():
+        prefix = f'{name}.' if name else ''
+        numel = int(np.prod(entry['shape']))
+        mask = np.unpackbits(entry['mask'].numpy(), count=numel).astype(bool)
+        mask = torch.from_numpy(mask).view(entry['shape'])
+        dtype = gate_layers[name].weight.dtype
+        if 'values' in entry:
+            weight = torch.zeros(entry['shape'], dtype=dtype)
+            weight[mask] = entry['values'].to(dtype)
+        else:
+            weight = entry['weight'].to(dtype)
+        state[prefix + 'weight'] = weight
+        state[prefix + 'mask.gumbel_pi'] = torch.where(mask, 1.5, -1.5).to(dtype)
+
+    model_state = model.state_dict()
+    model.load_state_dict({k: v.to(model_state[k].dtype) for k, v in state.items()})
+    print('Loaded pruned model from %s...' % fname)
+    if compact:
+        return compact_model(model, example_input)
+    return model
@@ -0,0 +1,90 @@
+"""Data-parallel training with torch.distributed, launched by torchrun:
+
+    torchrun --nproc_per_node 4 main.py --mode prune ...
+
+Every process trains on its shard of each batch (--batch_size stays the global batch
+size) through DistributedDataParallel, which averages all gradients, including those of
+gumbel_pi. Only rank 0 writes checkpoints, pseudo labels and logs, and runs evaluation
+and mining; the other ranks wait at a barrier when they need its files. The processes
+use gloo on CPU (nccl on GPU) and must share the checkpoint folder.
+Without torchrun (no WORLD_SIZE in the environment) everything is a no-op.
+"""
+import os
+import builtins
+import logging
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from munch import Munch
+
+
+def init_distributed():
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1 or dist.is_initialized():
+        return
+    if torch.cuda.is_available():
+        torch.cuda.set_device(int(os.environ['LOCAL_RANK']))
+        dist.init_process_group(backend='nccl')
+    else:
+        # torchrun limits every process to one thread. Split the cores of the node instead
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', get_world_size()))
+        torch.set_num_threads(max(1, os.cpu_count() // local_world_size))
+        dist.init_process_group(backend='gloo')
+
+    if not is_main_process():
+        builtin_print = builtins.print
+
+        def print(*args, force=False, **kwargs):
+            if force:
+                builtin_print(*args, **kwargs)
+
+        builtins.print = print
+        logging.disable(logging.CRITICAL)
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    if is_distributed():
+        return dist.get_world_size()
+    return int(os.environ.get('WORLD_SIZE', 1))
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_gather_object(obj):
+    # [obj of rank 0, obj of rank 1, ...]
+    if not is_distributed():
+        return [obj]
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
+
+
+def wrap_models(nets):
+    """DistributedDataParallel wrappers of `nets` to run the training forwards through.
+    Some parameters receive no gradient in a phase (gumbel_pi in pretraining and
+    retraining, weights of the biased classifier while pruning)."""
+    if not is_distributed():
+        return nets
+    device_ids = [torch.cuda.current_device()] if torch.cuda.is_available() else None
+    return Munch({name: DistributedDataParallel(net, device_ids=device_ids, find_unused_parameters=True)
+                  for name, net in nets.items()})
@@ -0,0 +1,35 @@
+import os
+import numpy as np
+
+
+def atomic_save(path, writer):
+    """Call writer(tmp) to write the file at `path` under a temporary name, then rename it,
+    so that a partially written file is never picked up. The temporary name keeps the
+    extension (np.save/np.savez would append it) and is unique per process."""
+    root, ext = os.path.splitext(path)
+    tmp = f'{root}.{os.getpid()}.tmp{ext}'
+    try:
+        writer(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class LazyMemmap(object):
+    """Base of objects reading .npy files through np.load(mmap_mode=...), opened on
+    first access. Pickled copies (e.g. in DataLoader workers) re-open the mappings
+    themselves, and all of them share the files through the page cache."""
+    mmap_mode = 'r'
+
+    def mapped(self, path):
+        if not hasattr(self, '_mapped'):
+            self._mapped = {}
+        if path not in self._mapped:
+            self._mapped[path] = np.load(path, mmap_mode=self.mmap_mode)
+        return self._mapped[path]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_mapped', None)
+        return state
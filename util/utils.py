@@ -20,6 +20,7 @@ import warnings
 from pathlib import Path
 from itertools import chain
 import pickle
+import random
 
 from tqdm import tqdm
 import matplotlib.pyplot as plt
@@ -31,6 +32,8 @@ import torch.nn.functional as F
 import torchvision
 import torchvision.utils as vutils
 
+from util import distributed
+
 
 def save_json(json_file, filename):
     with open(filename, 'w') as f:
@@ -54,29 +57,63 @@ def he_init(module):
             nn.init.constant_(module.bias, 0)
 
 class MultiDimAverageMeter(object):
+    """Groupwise average over an attribute grid of shape `dims`. Sums are accumulated
+    with bincount on the device of the added values and only copied to the host by
+    get_mean()."""
     def __init__(self, dims):
         self.dims = dims
-        self.cum = torch.zeros(np.prod(dims))
-        self.cnt = torch.zeros(np.prod(dims))
-        self.idx_helper = torch.arange(np.prod(dims), dtype=torch.long).reshape(
-            *dims
-        )
+        self.num_cells = int(np.prod(dims))
+        # Row-major strides: flat index = sum_k idxs[:, k] * strides[k]
+        self.strides = torch.tensor([int(np.prod(dims[k + 1:])) for k in range(len(dims))],
+                                    dtype=torch.long)
+        self.cum = torch.zeros(self.num_cells)
+        self.cnt = torch.zeros(self.num_cells)
 
     def add(self, vals, idxs):
-        flattened_idx = torch.stack(
-            [self.idx_helper[tuple(idxs[i])] for i in range(idxs.size(0))],
-            dim=0,
-        )
-        self.cum.index_add_(0, flattened_idx, vals.view(-1).float())
-        self.cnt.index_add_(0, flattened_idx, torch.ones_like(vals.view(-1), dtype=torch.float))
+        device = vals.device
+        if self.cum.device != device:
+            self.cum, self.cnt, self.strides = self.cum.to(device), self.cnt.to(device), self.strides.to(device)
+        flattened_idx = (idxs.to(device).long() * self.strides).sum(1)
+        self.cum += torch.bincount(flattened_idx, weights=vals.view(-1).float(), minlength=self.num_cells)
+        self.cnt += torch.bincount(flattened_idx, minlength=self.num_cells).float()
 
     def get_mean(self):
-        return (self.cum / self.cnt).reshape(*self.dims)
+        return (self.cum / self.cnt).reshape(*self.dims).cpu()
 
     def reset(self):
         self.cum.zero_()
         self.cnt.zero_()
 
+class MetricBuffer(object):
+    """Running sums of scalar tensors kept on their device. flush() copies all means to
+    the host at once and resets, so logging costs one synchronization per flush.
+    With `runs`, values are sums over that many runs trained together and flush() returns
+    the means of one run."""
+    def __init__(self, runs=1):
+        self.sums = {}
+        self.count = 0
+        self.runs = runs
+
+    def add(self, **metrics):
+        for key, value in metrics.items():
+            value = value.detach().float()
+            self.sums[key] = value if key not in self.sums else self.sums[key] + value
+        self.count += 1
+
+    def flush(self):
+        if not self.sums:
+            return {}
+        values = torch.stack(list(self.sums.values())).div_(self.count * self.runs).tolist()
+        means = dict(zip(self.sums.keys(), values))
+        self.sums, self.count = {}, 0
+        return means
+
+    def state_dict(self):
+        return dict(sums=self.sums, count=self.count)
+
+    def load_state_dict(self, state):
+        self.sums, self.count = dict(state['sums']), state['count']
+
 class ValidLogger(object):
     phase_token = ['ERM', 'prune', 'retrain', 'ratio']
 
@@ -96,6 +133,8 @@ class ValidLogger(object):
         self.log[which].append(val)
 
     def save(self):
+        if not distributed.is_main_process():
+            return
         with open(self.fname, 'wb') as f:
             pickle.dump(self.log, f)
             print(f'saved validation log in {self.fname}')
@@ -131,6 +170,19 @@ class EMA:
         label_index = torch.where(self.label == label)[0]
         return self.parameter[label_index].max()
 
+def get_rng_state():
+    state = dict(torch=torch.get_rng_state(), numpy=np.random.get_state(), random=random.getstate())
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'].cpu())
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
 def moving_average_param(model, model_test, beta=0.999):
     for param, param_test in zip(model.parameters(), model_test.parameters()):
         param_test.data = torch.lerp(param.data, param_test.data, beta)